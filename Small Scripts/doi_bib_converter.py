@@ -7,34 +7,97 @@ Production version for Apache2 deployment
 
 import re
 import requests
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
-from flask import Flask, render_template_string, request, Response, jsonify
+from requests.adapters import HTTPAdapter
+from flask import Flask, render_template_string, request, Response, jsonify, url_for
 from urllib.parse import quote
 import logging
 import time
 import os
 import json
-from typing import List, Set, Dict, Tuple
+import gzip
+import random
+import hashlib
+import itertools
+import sqlite3
+import tempfile
+import threading
+import uuid
+import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from contextlib import contextmanager
+from typing import List, Set, Dict, Tuple, NamedTuple, Optional
+
+# Configure logging for production. Per-DOI detail is logged at DEBUG; each
+# conversion logs one summary record at INFO, for a sampled fraction of requests
+LOG_FILE = os.environ.get('DOI_LOG_FILE', '/var/log/apache2/bib-convert.log')
+LOG_LEVEL = os.environ.get('DOI_LOG_LEVEL', 'INFO').upper()
+if not isinstance(logging.getLevelName(LOG_LEVEL), int):
+    # Unknown level name - basicConfig would refuse it and the app would not load
+    invalid_log_level, LOG_LEVEL = LOG_LEVEL, 'INFO'
+else:
+    invalid_log_level = None
+LOG_SAMPLE_RATE = float(os.environ.get('DOI_LOG_SAMPLE_RATE', 1.0))
 
-# Configure logging for production
 try:
     logging.basicConfig(
-        level=logging.INFO,
+        level=LOG_LEVEL,
         format='%(asctime)s %(levelname)s:%(name)s:%(message)s',
         handlers=[
-            logging.FileHandler('/var/log/apache2/bib-convert.log'),
+            logging.FileHandler(LOG_FILE),
             logging.StreamHandler()
         ]
     )
-except PermissionError:
+except OSError:
     # Fallback if can't write to log file
     logging.basicConfig(
-        level=logging.INFO,
+        level=LOG_LEVEL,
         format='%(asctime)s %(levelname)s:%(name)s:%(message)s'
     )
+if invalid_log_level:
+    logging.warning("Unknown DOI_LOG_LEVEL %r, logging at INFO", invalid_log_level)
 
 app = Flask(__name__)
+summary_logger = app.logger.getChild('summary')
+
+class ConversionLog:
+    """Counts and phase timings of one conversion, logged as a single JSON summary record"""
+    
+    def __init__(self, mode):
+        self.started = time.perf_counter()
+        self.fields = {'mode': mode}
+        self.timings = {}
+    
+    @contextmanager
+    def phase(self, name):
+        """Time a phase of the conversion; repeated phases add up"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + time.perf_counter() - started
+    
+    def timed(self, name, iterable):
+        """Iterate, adding the time spent waiting for each item to a phase"""
+        iterator = iter(iterable)
+        while True:
+            try:
+                with self.phase(name):
+                    item = next(iterator)
+            except StopIteration:
+                return
+            yield item
+    
+    def set(self, **fields):
+        self.fields.update(fields)
+    
+    def emit(self):
+        """Log the summary if INFO is enabled and this conversion is sampled"""
+        if not summary_logger.isEnabledFor(logging.INFO) or random.random() >= LOG_SAMPLE_RATE:
+            return
+        record = dict(self.fields, total_ms=round(1000 * (time.perf_counter() - self.started), 1))
+        record.update((f"{name}_ms", round(1000 * seconds, 1)) for name, seconds in self.timings.items())
+        summary_logger.info("%s", json.dumps(record))
 
 # HTML template for the web interface
 HTML_TEMPLATE = """
@@ -213,6 +276,16 @@ See https://doi.org/10.1126/science.1234567 for details..."></textarea>
                 </div>
             </div>
             
+            <div class="form-group">
+                <label for="libraryFile">Existing BibTeX library (optional):</label>
+                <input type="file" id="libraryFile" name="libraryFile" accept=".bib,text/plain">
+                <div class="checkbox-group">
+                    <input type="checkbox" id="libraryMode" name="libraryMode" value="merge">
+                    <label for="libraryMode">Return the merged library instead of only the new entries</label>
+                </div>
+                <div class="info">DOIs already in the library are not looked up again and are cited with their existing keys; new keys never clash with the library's.</div>
+            </div>
+            
             <div class="form-group">
                 <div class="checkbox-group">
                     <input type="checkbox" id="autoDownload" name="autoDownload" checked>
@@ -265,6 +338,62 @@ See https://doi.org/10.1126/science.1234567 for details..."></textarea>
             markdownInfo.style.display = this.checked ? 'block' : 'none';
         });
         
+        function showResult(result) {
+            // Display the main result and download it with any rewritten texts
+            const resultDiv = document.getElementById('result');
+            const format = new FormData(document.getElementById('doiForm')).get('format');
+            resultDiv.innerHTML = '<div class="result">' + escapeHtml(result.main_content) + '</div>';
+            
+            // Auto-download if enabled
+            if (document.getElementById('autoDownload').checked) {
+                downloadFile(result.main_content, format);
+                
+                // Also download TeX file if available
+                if (result.tex_content) {
+                    downloadFile(result.tex_content, 'tex');
+                }
+                
+                // Also download Markdown file if available
+                if (result.markdown_content) {
+                    downloadFile(result.markdown_content, 'markdown');
+                }
+            }
+        }
+        
+        async function readEventStream(response, onEvent) {
+            // Parse Server-Sent Events from the response body; resolves with the summary
+            const reader = response.body.getReader();
+            const decoder = new TextDecoder();
+            let buffer = '';
+            let summary = null;
+            
+            while (true) {
+                const chunk = await reader.read();
+                if (chunk.done) break;
+                buffer += decoder.decode(chunk.value, { stream: true });
+                
+                let boundary;
+                while ((boundary = buffer.indexOf('\\n\\n')) >= 0) {
+                    const block = buffer.slice(0, boundary);
+                    buffer = buffer.slice(boundary + 2);
+                    
+                    let event = 'message', data = '';
+                    for (const line of block.split('\\n')) {
+                        if (line.startsWith('event: ')) event = line.slice(7);
+                        else if (line.startsWith('data: ')) data += line.slice(6);
+                    }
+                    const payload = JSON.parse(data);
+                    
+                    if (event === 'error') throw new Error(payload.message);
+                    if (event === 'summary') summary = payload;
+                    onEvent(event, payload);
+                }
+            }
+            
+            if (!summary) throw new Error('Connection closed before the conversion finished');
+            return summary;
+        }
+        
         document.getElementById('doiForm').addEventListener('submit', async function(e) {
             e.preventDefault();
             
@@ -308,11 +437,37 @@ See https://doi.org/10.1126/science.1234567 for details..."></textarea>
             submitButton.textContent = 'Processing...';
             
             try {
+                // BibTeX is streamed so progress and entries show up as lookups complete
+                const streaming = format === 'bibtex';
+                if (streaming) {
+                    formData.append('stream', 'sse');
+                }
+                
                 const response = await fetch('convert', {
                     method: 'POST',
                     body: formData
                 });
                 
+                if (response.ok && streaming) {
+                    clearInterval(progressInterval);
+                    resultDiv.innerHTML = '<div class="result"></div>';
+                    const liveResult = resultDiv.firstChild;
+                    
+                    const result = await readEventStream(response, function(event, data) {
+                        if (event === 'progress') {
+                            progressFill.style.width = (data.total ? 100 * data.done / data.total : 100) + '%';
+                            progressText.textContent = `Processed ${data.done} of ${data.total} DOIs...`;
+                        } else if (event === 'entry') {
+                            liveResult.textContent += data.entry + '\\n';
+                        }
+                    });
+                    
+                    progressText.textContent = result.failed.length ?
+                        `Complete! ${result.failed.length} DOIs could not be resolved.` : 'Complete!';
+                    showResult(result);
+                    return;
+                }
+                
                 clearInterval(progressInterval);
                 progressFill.style.width = '100%';
                 progressText.textContent = 'Complete!';
@@ -322,25 +477,7 @@ See https://doi.org/10.1126/science.1234567 for details..."></textarea>
                     
                     if (contentType.includes('application/json')) {
                         // Multi-file response (when TeX or Markdown is enabled)
-                        const result = await response.json();
-                        
-                        // Display the main result
-                        resultDiv.innerHTML = '<div class="result">' + escapeHtml(result.main_content) + '</div>';
-                        
-                        // Auto-download if enabled
-                        if (autoDownload) {
-                            downloadFile(result.main_content, format);
-                            
-                            // Also download TeX file if available
-                            if (result.tex_content) {
-                                downloadFile(result.tex_content, 'tex');
-                            }
-                            
-                            // Also download Markdown file if available
-                            if (result.markdown_content) {
-                                downloadFile(result.markdown_content, 'markdown');
-                            }
-                        }
+                        showResult(await response.json());
                     } else {
                         // Single file response
                         const result = await response.text();
@@ -423,9 +560,235 @@ See https://doi.org/10.1126/science.1234567 for details..."></textarea>
 </html>
 """
 
-# Rate limiting
-last_request_time = 0
-MIN_REQUEST_INTERVAL = 0.1  # 100ms between requests (10 requests/second to be polite)
+# CrossRef API access
+CROSSREF_API_URL = os.environ.get('CROSSREF_API_URL', 'https://api.crossref.org')
+MAX_CONCURRENT_REQUESTS = 5  # Parallel lookups shared by all interactive requests of this process
+JOB_CONCURRENT_REQUESTS = 2  # Parallel lookups shared by all background jobs, on their own threads
+REQUESTS_PER_SECOND = 10  # Global rate limit (10 requests/second to be polite)
+RATE_LIMIT_BURST = 5
+CROSSREF_BATCH_SIZE = int(os.environ.get('CROSSREF_BATCH_SIZE', 20))  # DOIs per filter query
+# Lookups one conversion may have queued on its pool at a time, so a large
+# conversion can't push the ones that arrive after it to the back of the queue
+MAX_LOOKUPS_IN_FLIGHT = MAX_CONCURRENT_REQUESTS
+
+class TokenBucket:
+    """Thread-safe token bucket rate limiter shared by all WSGI threads"""
+    
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+    
+    def acquire(self):
+        """Block until a request may be sent"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+rate_limiter = TokenBucket(REQUESTS_PER_SECOND, RATE_LIMIT_BURST)
+
+# Keep-alive session with one pooled connection per fetch thread
+http_session = requests.Session()
+http_session.headers.update({
+    'User-Agent': 'DOI-Bibliography-Converter/1.0 (mailto:user@example.com)',
+    'Accept': 'application/json'
+})
+http_session.mount('https://', HTTPAdapter(pool_connections=1,
+                                           pool_maxsize=MAX_CONCURRENT_REQUESTS + JOB_CONCURRENT_REQUESTS))
+http_session.mount('http://', HTTPAdapter(pool_connections=1,
+                                          pool_maxsize=MAX_CONCURRENT_REQUESTS + JOB_CONCURRENT_REQUESTS))
+
+# Threads persist across requests so the pooled connections are reused. Background
+# jobs get their own threads, so they never hold the ones interactive requests wait for
+fetch_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_REQUESTS, thread_name_prefix='crossref')
+job_fetch_executor = ThreadPoolExecutor(max_workers=JOB_CONCURRENT_REQUESTS, thread_name_prefix='crossref-jobs')
+
+# Persistent metadata cache (set DOI_CACHE_PATH to an empty string to disable)
+CACHE_PATH = os.environ.get('DOI_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'bib-convert-cache.sqlite'))
+CACHE_TTL = int(os.environ.get('DOI_CACHE_TTL', 30 * 24 * 3600))  # Seconds before metadata is fetched again
+CACHE_NEGATIVE_TTL = int(os.environ.get('DOI_CACHE_NEGATIVE_TTL', 24 * 3600))  # Seconds to remember unknown DOIs
+CACHE_MAX_ENTRIES = int(os.environ.get('DOI_CACHE_MAX_ENTRIES', 100000))
+
+class SQLiteStore:
+    """Base for the on-disk stores: one SQLite connection per thread"""
+    
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()
+    
+    def connection(self):
+        """One connection per thread; WAL lets WSGI processes read while another writes"""
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self.local.conn = conn
+        return conn
+
+class MetadataCache(SQLiteStore):
+    """SQLite cache of CrossRef metadata keyed by normalized DOI, with TTL and LRU eviction"""
+    
+    EVICT_EVERY = 100  # Check the size bound every this many stores
+    
+    def __init__(self, path, ttl=CACHE_TTL, negative_ttl=CACHE_NEGATIVE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        super().__init__(path)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        
+        with self.connection() as conn:
+            # metadata is NULL for DOIs CrossRef does not know (negative entries)
+            conn.execute("""CREATE TABLE IF NOT EXISTS metadata (
+                doi TEXT PRIMARY KEY, metadata TEXT, stored REAL NOT NULL, accessed REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS metadata_accessed ON metadata (accessed)")
+    
+    def count(self, hit):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+    
+    def get(self, doi):
+        """Return (found, metadata); metadata is None for a cached failed lookup"""
+        now = time.time()
+        conn = self.connection()
+        row = conn.execute("SELECT metadata, stored FROM metadata WHERE doi = ?", (doi,)).fetchone()
+        
+        if row is None or now - row[1] > (self.ttl if row[0] is not None else self.negative_ttl):
+            self.count(hit=False)
+            return False, None
+        
+        with conn:
+            conn.execute("UPDATE metadata SET accessed = ? WHERE doi = ?", (now, doi))
+        self.count(hit=True)
+        return True, json.loads(row[0]) if row[0] is not None else None
+    
+    def put(self, doi, metadata):
+        """Store metadata for a DOI, or None to remember that the lookup failed"""
+        now = time.time()
+        value = json.dumps(metadata) if metadata is not None else None
+        conn = self.connection()
+        with conn:
+            conn.execute("INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?)", (doi, value, now, now))
+        
+        with self.lock:
+            self.stores += 1
+            evict = self.stores % self.EVICT_EVERY == 0
+        if evict:
+            self.evict()
+    
+    def evict(self):
+        """Drop the least recently used entries beyond max_entries"""
+        conn = self.connection()
+        with conn:
+            excess = conn.execute("SELECT COUNT(*) FROM metadata").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("""DELETE FROM metadata WHERE doi IN (
+                    SELECT doi FROM metadata ORDER BY accessed LIMIT ?)""", (excess,))
+    
+    def stats(self):
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        entries = self.connection().execute("SELECT COUNT(*) FROM metadata").fetchone()[0]
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / (hits + misses) if hits + misses else 0.0,
+            'entries': entries,
+            'max_entries': self.max_entries,
+        }
+
+metadata_cache = None
+if CACHE_PATH:
+    try:
+        metadata_cache = MetadataCache(CACHE_PATH)
+    except sqlite3.Error as e:
+        # Fallback if the cache file can't be created
+        app.logger.warning("Metadata cache disabled: %s", e)
+
+# Local metadata backend: an SQLite file built from a CrossRef JSON-lines dump
+# (see the ingest command below), consulted before the cache and the network.
+# With DOI_OFFLINE=1, DOIs missing from it are reported as failed instead of fetched
+LOCAL_METADATA_PATH = os.environ.get('DOI_LOCAL_METADATA_PATH', '')
+OFFLINE = os.environ.get('DOI_OFFLINE', '') == '1'
+
+class LocalMetadataStore(SQLiteStore):
+    """Read-mostly store of normalized records keyed by normalized DOI, loaded from a dump"""
+    
+    INGEST_BATCH = 5000  # Rows per executemany while ingesting
+    
+    def __init__(self, path):
+        super().__init__(path)
+        with self.connection() as conn:
+            conn.execute("CREATE TABLE IF NOT EXISTS works (doi TEXT PRIMARY KEY, record TEXT NOT NULL)")
+    
+    def get(self, doi):
+        """Return the BibRecord for a normalized DOI, or None if the dump does not have it"""
+        row = self.connection().execute("SELECT record FROM works WHERE doi = ?", (doi,)).fetchone()
+        return record_from_json(json.loads(row[0])) if row else None
+    
+    def ingest(self, path):
+        """
+        Load a JSON-lines dump (optionally gzipped) and return the number of works
+        stored. Each line is a work, a {"message": work} API response or a
+        {"items": [...]} page as in the CrossRef public data file. Malformed lines
+        and works are logged and skipped; every INGEST_BATCH rows are committed,
+        so an interrupted ingest keeps what it loaded
+        """
+        opener = gzip.open if path.endswith('.gz') else open
+        stored = 0
+        batch = []
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    data = json.loads(line)
+                    data = data.get('message', data)
+                    works = list(data.get('items', [data]))
+                except (ValueError, AttributeError, TypeError) as e:
+                    app.logger.warning("Skipping line %d of %s: %s %s", line_number, path, type(e).__name__, e)
+                    continue
+                for work in works:
+                    try:
+                        batch.append((normalize_doi(work['DOI']), json.dumps(normalize_metadata(work))))
+                    except (KeyError, IndexError, ValueError, AttributeError, TypeError) as e:
+                        app.logger.warning("Skipping a work on line %d of %s: %s %s",
+                                           line_number, path, type(e).__name__, e)
+                if len(batch) >= self.INGEST_BATCH:
+                    stored += self.store(batch)
+                    batch = []
+        return stored + self.store(batch)
+    
+    def store(self, rows):
+        """Insert ingested rows in their own transaction"""
+        with self.connection() as conn:
+            conn.executemany("INSERT OR REPLACE INTO works VALUES (?, ?)", rows)
+        return len(rows)
+    
+    def stats(self):
+        return {'entries': self.connection().execute("SELECT COUNT(*) FROM works").fetchone()[0]}
+
+local_metadata = None
+if LOCAL_METADATA_PATH:
+    try:
+        local_metadata = LocalMetadataStore(LOCAL_METADATA_PATH)
+    except sqlite3.Error as e:
+        app.logger.warning("Local metadata store disabled: %s", e)
 
 def clean_doi(doi_string):
     """Extract clean DOI from various input formats"""
@@ -446,135 +809,294 @@ def clean_doi(doi_string):
     
     return doi_string
 
+# Single pattern for all DOI forms (URLs with or without protocol, doi: prefix, bare).
+# The optional prefix is consumed together with the DOI, so a scan yields one
+# non-overlapping span per citation; stops at whitespace, brackets, commas and semicolons
+DOI_PATTERN = re.compile(
+    r'(?:(?:https?://)?(?:dx\.)?doi\.org/|doi:\s*)?(10\.\d{4,}/[^\s()\[\],;]+)', re.IGNORECASE)
+VALID_DOI_PATTERN = re.compile(r'^10\.\d{4,}/[a-zA-Z0-9.\-_()/]+$')
+DOI_PREFIX_PATTERN = re.compile(r'10\.\d{4,}')
+TRAILING_PUNCTUATION = '.,;:)]}'
+
 def extract_dois_from_text(text: str) -> List[Tuple[str, int, int]]:
-    """Extract all DOIs from text using regex patterns, returning DOI, start, end positions"""
-    doi_patterns = [
-        # Standard DOI pattern - more permissive, stops at whitespace, brackets, or end of sentence
-        r'10\.\d{4,}\/[^\s\(\)\[\]\,\;]+',
-        # DOI with doi: prefix
-        r'doi:\s*10\.\d{4,}\/[^\s\(\)\[\]\,\;]+',
-        # DOI URLs
-        r'https?:\/\/(?:dx\.)?doi\.org\/10\.\d{4,}\/[^\s\(\)\[\]\,\;]+',
-        # DOI URLs without protocol
-        r'(?:dx\.)?doi\.org\/10\.\d{4,}\/[^\s\(\)\[\]\,\;]+'
-    ]
-    
+    """Extract all DOIs from text in one pass, returning DOI, start, end positions in text order"""
     found_dois = []
     
-    app.logger.info(f"Extracting DOIs from text: {text[:200]}...")
-    
-    for i, pattern in enumerate(doi_patterns):
-        matches = re.finditer(pattern, text, re.IGNORECASE)
-        for match in matches:
-            raw_doi = match.group()
-            start_pos = match.start()
-            end_pos = match.end()
-            
-            app.logger.info(f"Pattern {i+1} found raw match: '{raw_doi}' at {start_pos}-{end_pos}")
-            
-            # Clean the DOI
-            cleaned_doi = clean_doi(raw_doi)
-            app.logger.info(f"Cleaned to: '{cleaned_doi}'")
-            
-            # Validate that it's actually a DOI (has the right structure)
-            if re.match(r'^10\.\d{4,}\/[a-zA-Z0-9\.\-_\(\)\/]+$', cleaned_doi):
-                found_dois.append((cleaned_doi, start_pos, end_pos))
-                app.logger.info(f"Added valid DOI: '{cleaned_doi}' at {start_pos}-{end_pos}")
-            else:
-                app.logger.warning(f"Rejected invalid DOI format: '{cleaned_doi}'")
-    
-    # Sort by start position to maintain order
-    found_dois.sort(key=lambda x: x[1])
+    for match in DOI_PATTERN.finditer(text):
+        doi = match.group(1)
+        end_pos = match.end()
+        
+        # Trailing sentence punctuation is not part of the DOI nor of its span
+        while doi and doi[-1] in TRAILING_PUNCTUATION:
+            doi = doi[:-1]
+            end_pos -= 1
+        
+        if VALID_DOI_PATTERN.match(doi):
+            found_dois.append((doi, match.start(), end_pos))
+        else:
+            app.logger.debug("Rejected invalid DOI format: '%s'", doi)
     
-    app.logger.info(f"Final extracted DOIs with positions: {found_dois}")
+    app.logger.debug("Extracted %d DOIs from text of length %d", len(found_dois), len(text))
     return found_dois
 
-def parse_input_text(input_text: str) -> List[str]:
+def parse_input_text(input_text: str, dois_with_positions: List[Tuple[str, int, int]] = None) -> List[str]:
     """Parse input text to extract DOIs, handling both line-by-line DOIs and full text"""
     input_text = input_text.strip()
     
     if not input_text:
         return []
     
-    app.logger.info(f"Parsing input text of length {len(input_text)}")
+    app.logger.debug("Parsing input text of length %d", len(input_text))
     
-    # First, try to extract DOIs from the entire text
-    extracted_dois_with_pos = extract_dois_from_text(input_text)
-    extracted_dois = [doi for doi, _, _ in extracted_dois_with_pos]
-    app.logger.info(f"Extracted DOIs from full text: {extracted_dois}")
+    # First, try to extract DOIs from the entire text (unless already scanned by the caller)
+    if dois_with_positions is None:
+        dois_with_positions = extract_dois_from_text(input_text)
+    extracted_dois = [doi for doi, _, _ in dois_with_positions]
     
     # Also check if input looks like line-by-line DOIs
-    lines = [line.strip() for line in input_text.split('\n') if line.strip()]
-    line_dois = set()
-    
-    app.logger.info(f"Processing {len(lines)} lines for line-by-line DOIs")
-    
-    for line in lines:
+    line_dois = []
+    for line in input_text.split('\n'):
         # If line looks like it might be a DOI (contains the typical pattern)
-        if re.search(r'10\.\d{4,}', line):
+        if DOI_PREFIX_PATTERN.search(line):
             clean_doi_str = clean_doi(line)
-            app.logger.info(f"Line '{line[:50]}...' -> cleaned: '{clean_doi_str}'")
-            if clean_doi_str and re.match(r'^10\.\d{4,}\/[a-zA-Z0-9\.\-_\(\)\/]+$', clean_doi_str):
-                line_dois.add(clean_doi_str)
-                app.logger.info(f"Added line DOI: '{clean_doi_str}'")
-    
-    # Combine both methods, preferring extracted DOIs if we found any
-    all_dois_set = set(extracted_dois).union(line_dois) if extracted_dois else line_dois
+            if clean_doi_str and VALID_DOI_PATTERN.match(clean_doi_str):
+                line_dois.append(clean_doi_str)
     
     # Preserve order from extracted DOIs, then add any additional from line parsing
-    result = []
-    for doi in extracted_dois:
-        if doi not in result:
-            result.append(doi)
-    
-    for doi in line_dois:
-        if doi not in result:
-            result.append(doi)
+    result = list(dict.fromkeys(extracted_dois + line_dois))
     
-    app.logger.info(f"Final combined DOIs: {result}")
+    app.logger.debug("Found %d distinct DOIs", len(result))
     return result
 
-def fetch_doi_metadata(doi):
-    """Fetch metadata for a DOI from CrossRef with rate limiting"""
-    global last_request_time
+def normalize_doi(doi):
+    """Cache key for a DOI: cleaned and lower-cased, since DOIs are case-insensitive"""
+    return clean_doi(doi).lower()
+
+class BibRecord(NamedTuple):
+    """CrossRef metadata reduced to what the exporters use; also what the cache stores"""
+    doi: Optional[str]
+    entry_type: str  # BibTeX entry type
+    title: Optional[str]
+    authors: Tuple[Tuple[Optional[str], Optional[str]], ...]  # (given, family) per author
+    container: Optional[str]
+    year: str
+    volume: Optional[str]
+    issue: Optional[str]
+    page: Optional[str]
+    url: Optional[str]
+
+def normalize_metadata(metadata: dict) -> BibRecord:
+    """Convert a CrossRef work message into a BibRecord in one pass"""
+    # Determine entry type based on publication type
+    pub_type = metadata.get('type', '').lower()
+    if 'book' in pub_type:
+        entry_type = "book"
+    elif 'conference' in pub_type or 'proceedings' in pub_type:
+        entry_type = "inproceedings"
+    else:
+        entry_type = "article"  # Default to article
     
+    year = ""
+    for date_field in ('created', 'published-print', 'published-online'):
+        if date_field in metadata:
+            year = str(metadata[date_field]['date-parts'][0][0])
+            break
+    
+    return BibRecord(
+        doi=metadata.get('DOI'),
+        entry_type=entry_type,
+        title=metadata['title'][0] if metadata.get('title') else None,
+        authors=tuple((author.get('given'), author.get('family')) for author in metadata.get('author') or ()),
+        container=metadata['container-title'][0] if metadata.get('container-title') else None,
+        year=year,
+        volume=metadata.get('volume'),
+        issue=metadata.get('issue'),
+        page=metadata.get('page'),
+        url=metadata.get('URL'),
+    )
+
+def record_from_json(value) -> BibRecord:
+    """Rebuild a cached BibRecord (entries cached before records existed hold the raw message)"""
+    if isinstance(value, dict):
+        return normalize_metadata(value)
+    record = BibRecord(*value)
+    return record._replace(authors=tuple(tuple(author) for author in record.authors))
+
+def local_record(doi):
+    """Look a DOI up in the local metadata store, if configured"""
+    if local_metadata:
+        try:
+            return local_metadata.get(normalize_doi(doi))
+        except sqlite3.Error as e:
+            app.logger.warning("Local metadata lookup failed for %s: %s", doi, e)
+    return None
+
+def cached_metadata(doi):
+    """Look a DOI up in the metadata cache; returns (found, record)"""
+    if metadata_cache:
+        try:
+            found, value = metadata_cache.get(normalize_doi(doi))
+            return found, record_from_json(value) if value is not None else None
+        except sqlite3.Error as e:
+            app.logger.warning("Metadata cache lookup failed for %s: %s", doi, e)
+    return False, None
+
+def cache_metadata(doi, metadata):
+    """Store a lookup result in the metadata cache, if enabled"""
+    if metadata_cache:
+        try:
+            metadata_cache.put(normalize_doi(doi), metadata)
+        except sqlite3.Error as e:
+            app.logger.warning("Metadata cache store failed for %s: %s", doi, e)
+
+def fetch_doi_metadata(doi):
+    """Fetch metadata for a DOI from the local store, the cache or CrossRef with rate limiting"""
+    metadata = local_record(doi)
+    if metadata is not None:
+        return metadata
+    found, metadata = cached_metadata(doi)
+    if found or OFFLINE:
+        return metadata
+    return request_doi_metadata(doi)
+
+def request_doi_metadata(doi):
+    """Fetch metadata for a single DOI from CrossRef with rate limiting"""
     try:
-        # Rate limiting - ensure we don't exceed CrossRef's limits
-        current_time = time.time()
-        time_since_last = current_time - last_request_time
-        if time_since_last < MIN_REQUEST_INTERVAL:
-            time.sleep(MIN_REQUEST_INTERVAL - time_since_last)
-        
         clean_doi_str = clean_doi(doi)
-        url = f"https://api.crossref.org/works/{quote(clean_doi_str)}"
+        url = f"{CROSSREF_API_URL}/works/{quote(clean_doi_str)}"
         
-        headers = {
-            'User-Agent': 'DOI-Bibliography-Converter/1.0 (mailto:user@example.com)',
-            'Accept': 'application/json'
-        }
+        # Rate limiting - ensure we don't exceed CrossRef's limits
+        rate_limiter.acquire()
+        response = http_session.get(url, timeout=15)
         
-        last_request_time = time.time()
-        response = requests.get(url, headers=headers, timeout=15)
+        if response.status_code == 404:
+            # Unknown DOI - remember it, unlike transient errors which are retried next time
+            cache_metadata(doi, None)
         response.raise_for_status()
         
-        data = response.json()
-        return data['message']
+        record = normalize_metadata(response.json()['message'])
+        cache_metadata(doi, record)
+        return record
     
     except Exception as e:
-        app.logger.error(f"Error fetching DOI {doi}: {str(e)}")
+        app.logger.error("Error fetching DOI %s: %s", doi, e)
         return None
 
+def request_batch_metadata(dois: List[str]) -> Dict[str, BibRecord]:
+    """Fetch metadata for several DOIs with one CrossRef filter query, keyed by normalized DOI"""
+    # Rate limiting - one token per HTTP request, however many DOIs it carries
+    rate_limiter.acquire()
+    response = http_session.get(f"{CROSSREF_API_URL}/works", timeout=30, params={
+        'filter': ','.join(f"doi:{clean_doi(doi)}" for doi in dois),
+        'rows': len(dois),
+    })
+    response.raise_for_status()
+    
+    found = {}
+    for metadata in response.json()['message']['items']:
+        record = normalize_metadata(metadata)
+        found[normalize_doi(record.doi)] = record
+        cache_metadata(record.doi, record)
+    return found
+
+def resolve_batch(dois: List[str]) -> List[Optional[BibRecord]]:
+    """
+    Metadata for a batch of DOIs in order. A single DOI is looked up directly; in a
+    larger batch, DOIs the filter query misses (all of them if it fails) come back
+    as None for the caller to look up singly
+    """
+    if len(dois) == 1:
+        return [request_doi_metadata(dois[0])]
+    
+    found = {}
+    try:
+        found = request_batch_metadata(dois)
+    except Exception as e:
+        app.logger.warning("Batch lookup of %d DOIs failed, falling back to single lookups: %s", len(dois), e)
+    return [found.get(normalize_doi(doi)) for doi in dois]
+
+def iter_metadata(dois: List[str], log: ConversionLog = None, executor: ThreadPoolExecutor = None):
+    """
+    Yield (index, metadata) for each DOI as soon as it is resolved: local store
+    and cache hits first, then CrossRef batches of CROSSREF_BATCH_SIZE, at most
+    MAX_LOOKUPS_IN_FLIGHT of them submitted at a time. DOIs a batch misses are
+    queued again as single lookups, so they run concurrently with the rest.
+    Lookups run on fetch_executor unless another executor is given
+    """
+    executor = executor or fetch_executor
+    pending = []
+    local_hits = 0
+    for index, doi in enumerate(dois):
+        metadata = local_record(doi)
+        if metadata is not None:
+            local_hits += 1
+            yield index, metadata
+            continue
+        found, metadata = cached_metadata(doi)
+        if found:
+            yield index, metadata
+        else:
+            pending.append(index)
+    
+    misses = len(pending)
+    if OFFLINE:
+        # No network: whatever the local store and cache don't know fails
+        for index in pending:
+            yield index, None
+        pending = []
+    
+    batches = [pending[i:i + CROSSREF_BATCH_SIZE] for i in range(0, len(pending), CROSSREF_BATCH_SIZE)]
+    if log:
+        log.set(local_hits=local_hits, cache_hits=len(dois) - misses - local_hits,
+                cache_misses=misses, batches=len(batches))
+    
+    tasks = deque(batches)
+    running = {}
+    single_lookups = 0
+    try:
+        while tasks or running:
+            # Submit the next batch only as one finishes, leaving room on the pool for other requests
+            while tasks and len(running) < MAX_LOOKUPS_IN_FLIGHT:
+                batch = tasks.popleft()
+                running[executor.submit(resolve_batch, [dois[index] for index in batch])] = batch
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                batch = running.pop(future)
+                for index, metadata in zip(batch, future.result()):
+                    if metadata is None and len(batch) > 1:
+                        # Ahead of the remaining batches, so in-order output isn't held up by a miss
+                        tasks.appendleft([index])
+                        single_lookups += 1
+                    else:
+                        yield index, metadata
+        if log:
+            log.set(single_lookups=single_lookups)
+    finally:
+        # Consumer stopped early - don't spend lookups on the remaining batches
+        for future in running:
+            future.cancel()
+
+def fetch_all_metadata(dois: List[str], progress=None, log: ConversionLog = None,
+                       executor: ThreadPoolExecutor = None) -> List[BibRecord]:
+    """Fetch metadata for many DOIs concurrently, returned in input order (None for failures)"""
+    results = [None] * len(dois)
+    for done, (index, metadata) in enumerate(iter_metadata(dois, log, executor), 1):
+        results[index] = metadata
+        if progress:
+            progress(done, len(dois))
+    return results
+
 def format_authors_bibtex(authors):
     """Format authors for BibTeX"""
     if not authors:
         return ""
     
     author_list = []
-    for author in authors:
-        if 'family' in author and 'given' in author:
-            author_list.append(f"{author['family']}, {author['given']}")
-        elif 'family' in author:
-            author_list.append(author['family'])
+    for given, family in authors:
+        if family is not None and given is not None:
+            author_list.append(f"{family}, {given}")
+        elif family is not None:
+            author_list.append(family)
     
     return " and ".join(author_list)
 
@@ -584,333 +1106,828 @@ def format_authors_xml(authors):
         return ""
     
     author_list = []
-    for author in authors:
-        if 'family' in author and 'given' in author:
-            author_list.append(f"{author['given']} {author['family']}")
-        elif 'family' in author:
-            author_list.append(author['family'])
+    for given, family in authors:
+        if family is not None and given is not None:
+            author_list.append(f"{given} {family}")
+        elif family is not None:
+            author_list.append(family)
     
     return "; ".join(author_list)
 
 def generate_bibtex_key(metadata):
-    """Generate a BibTeX key from metadata"""
-    # Use first author's last name + year
-    authors = metadata.get('author', [])
-    year = ""
+    """Generate a BibTeX key from a record (or raw CrossRef metadata)"""
+    if isinstance(metadata, dict):
+        metadata = normalize_metadata(metadata)
     
-    if 'created' in metadata:
-        year = str(metadata['created']['date-parts'][0][0])
-    elif 'published-print' in metadata:
-        year = str(metadata['published-print']['date-parts'][0][0])
-    elif 'published-online' in metadata:
-        year = str(metadata['published-online']['date-parts'][0][0])
-    
-    if authors and 'family' in authors[0]:
-        first_author = authors[0]['family'].replace(' ', '').replace('-', '')
-        key = f"{first_author}{year}"
+    # Use first author's last name + year
+    if metadata.authors and metadata.authors[0][1] is not None:
+        first_author = metadata.authors[0][1].replace(' ', '').replace('-', '')
+        key = f"{first_author}{metadata.year}"
     else:
-        key = f"unknown{year}"
+        key = f"unknown{metadata.year}"
     
     return key
 
-def metadata_to_bibtex(metadata):
-    """Convert CrossRef metadata to BibTeX format"""
-    entry_type = "article"  # Default to article
+def metadata_to_bibtex(metadata, key=None):
+    """Convert a record (or raw CrossRef metadata) to BibTeX format, optionally with a preassigned key"""
+    if isinstance(metadata, dict):
+        metadata = normalize_metadata(metadata)
     
-    # Determine entry type based on publication type
-    pub_type = metadata.get('type', '').lower()
-    if 'book' in pub_type:
-        entry_type = "book"
-    elif 'conference' in pub_type or 'proceedings' in pub_type:
-        entry_type = "inproceedings"
-    
-    key = generate_bibtex_key(metadata)
+    key = key or generate_bibtex_key(metadata)
     
-    bibtex = f"@{entry_type}{{{key},\n"
+    bibtex = [f"@{metadata.entry_type}{{{key},\n"]
     
     # Title
-    if 'title' in metadata and metadata['title']:
-        title = metadata['title'][0].replace('{', '').replace('}', '')
-        bibtex += f"  title = {{{title}}},\n"
+    if metadata.title is not None:
+        title = metadata.title.replace('{', '').replace('}', '')
+        bibtex.append(f"  title = {{{title}}},\n")
     
     # Authors
-    if 'author' in metadata:
-        authors = format_authors_bibtex(metadata['author'])
-        if authors:
-            bibtex += f"  author = {{{authors}}},\n"
+    authors = format_authors_bibtex(metadata.authors)
+    if authors:
+        bibtex.append(f"  author = {{{authors}}},\n")
     
     # Journal
-    if 'container-title' in metadata and metadata['container-title']:
-        journal = metadata['container-title'][0]
-        bibtex += f"  journal = {{{journal}}},\n"
+    if metadata.container is not None:
+        bibtex.append(f"  journal = {{{metadata.container}}},\n")
     
     # Year
-    year = ""
-    if 'created' in metadata:
-        year = str(metadata['created']['date-parts'][0][0])
-    elif 'published-print' in metadata:
-        year = str(metadata['published-print']['date-parts'][0][0])
-    elif 'published-online' in metadata:
-        year = str(metadata['published-online']['date-parts'][0][0])
-    
-    if year:
-        bibtex += f"  year = {{{year}}},\n"
+    if metadata.year:
+        bibtex.append(f"  year = {{{metadata.year}}},\n")
     
     # Volume
-    if 'volume' in metadata:
-        bibtex += f"  volume = {{{metadata['volume']}}},\n"
+    if metadata.volume is not None:
+        bibtex.append(f"  volume = {{{metadata.volume}}},\n")
     
     # Issue/Number
-    if 'issue' in metadata:
-        bibtex += f"  number = {{{metadata['issue']}}},\n"
+    if metadata.issue is not None:
+        bibtex.append(f"  number = {{{metadata.issue}}},\n")
     
     # Pages
-    if 'page' in metadata:
-        bibtex += f"  pages = {{{metadata['page']}}},\n"
+    if metadata.page is not None:
+        bibtex.append(f"  pages = {{{metadata.page}}},\n")
     
     # DOI
-    if 'DOI' in metadata:
-        bibtex += f"  doi = {{{metadata['DOI']}}},\n"
+    if metadata.doi is not None:
+        bibtex.append(f"  doi = {{{metadata.doi}}},\n")
     
     # URL
-    if 'URL' in metadata:
-        bibtex += f"  url = {{{metadata['URL']}}},\n"
+    if metadata.url is not None:
+        bibtex.append(f"  url = {{{metadata.url}}},\n")
     
-    bibtex += "}\n"
+    bibtex.append("}\n")
     
-    return bibtex, key
+    return ''.join(bibtex), key
 
-def metadata_to_msword_xml(metadata_list):
-    """Convert list of CrossRef metadata to MS Word XML bibliography format"""
-    # Create root element
-    root = ET.Element("b:Sources")
-    root.set("SelectedStyle", "\\APASixthEditionOfficeOnline.xsl")
-    root.set("StyleName", "APA")
-    root.set("xmlns:b", "http://schemas.openxmlformats.org/officeDocument/2006/bibliography")
-    root.set("xmlns", "http://schemas.openxmlformats.org/officeDocument/2006/bibliography")
-    
-    for i, metadata in enumerate(metadata_list):
-        source = ET.SubElement(root, "b:Source")
+# Entry headers of an existing .bib library, e.g. "@article{Smith2020,"
+BIB_ENTRY_PATTERN = re.compile(r'@\s*(\w+)\s*([{(])\s*([^\s,{}()]+)\s*,')
+BIB_DELIMITER_PATTERN = re.compile(r'[{}()]')
+BIB_DOI_PATTERN = re.compile(r'\bdoi\s*=\s*[{"]\s*([^{}"]+?)\s*[}"]', re.IGNORECASE)
+BIB_NON_ENTRIES = {'string', 'comment', 'preamble'}
+
+def bib_entry_end(text: str, opener: int) -> int:
+    """Index just past the brace or parenthesis that closes the entry opened at text[opener]"""
+    closer = '}' if text[opener] == '{' else ')'
+    depth = 0
+    for match in BIB_DELIMITER_PATTERN.finditer(text, opener + 1):
+        delimiter = match.group()
+        if delimiter == '{':
+            depth += 1
+        elif delimiter == '}':
+            if depth == 0 and closer == '}':
+                return match.end()
+            depth -= 1
+        elif delimiter == ')' and depth == 0 and closer == ')':
+            return match.end()
+    return len(text)
+
+def parse_bib_library(library_text: str) -> List[Tuple[str, str, str]]:
+    """(key, normalized DOI or '', entry text) for each entry of a BibTeX library, in one pass"""
+    entries = []
+    position = 0
+    while True:
+        match = BIB_ENTRY_PATTERN.search(library_text, position)
+        if not match:
+            return entries
         
-        # Tag (unique identifier)
-        tag = ET.SubElement(source, "b:Tag")
-        tag.text = f"Source{i+1}"
+        end = bib_entry_end(library_text, match.start(2))
+        if match.group(1).lower() not in BIB_NON_ENTRIES:
+            entry = library_text[match.start():end]
+            doi = BIB_DOI_PATTERN.search(entry)
+            entries.append((match.group(3), normalize_doi(doi.group(1)) if doi else '', entry))
+        position = end
+
+def key_suffix(n: int) -> str:
+    """Disambiguation suffix number n: a, b, ..., z, aa, ab, ..."""
+    suffix = ""
+    n += 1
+    while n:
+        n, remainder = divmod(n - 1, 26)
+        suffix = chr(ord('a') + remainder) + suffix
+    return suffix
+
+class BibKeyAllocator:
+    """
+    Hands out unique BibTeX keys over a batch and, optionally, the keys of an
+    existing library: the first Smith2020 keeps its key, later ones become
+    Smith2020a, Smith2020b, ... BibTeX compares keys case-insensitively, so
+    the index does too. The same DOI always gets the same key.
+    """
+    
+    def __init__(self, existing_keys=()):
+        self.used = {key.lower() for key in existing_keys}
+        self.next_suffix = {}  # Base key -> next suffix number to try
+        self.doi_keys = {}  # Normalized DOI -> allocated key
+    
+    def allocate(self, metadata, doi: str = None) -> str:
+        """Key for a record; amortized O(1) per entry"""
+        doi = normalize_doi(doi or metadata.doi or '')
+        if doi in self.doi_keys:
+            return self.doi_keys[doi]
         
-        # Source type (most will be journal articles)
-        source_type = ET.SubElement(source, "b:SourceType")
-        source_type.text = "ArticleInAPeriodical"
+        base = generate_bibtex_key(metadata)
+        key = base
+        if key.lower() in self.used:
+            n = self.next_suffix.get(base.lower(), 0)
+            while (base + key_suffix(n)).lower() in self.used:
+                n += 1
+            key = base + key_suffix(n)
+            self.next_suffix[base.lower()] = n + 1
         
-        # Title
-        if 'title' in metadata and metadata['title']:
-            title = ET.SubElement(source, "b:Title")
-            title.text = metadata['title'][0]
+        self.used.add(key.lower())
+        if doi:
+            self.doi_keys[doi] = key
+        return key
+
+MSWORD_XML_NAMESPACE = "http://schemas.openxmlformats.org/officeDocument/2006/bibliography"
+MSWORD_XML_ROOT = (f'<b:Sources xmlns:b="{MSWORD_XML_NAMESPACE}" xmlns="{MSWORD_XML_NAMESPACE}" '
+                   f'SelectedStyle="\\APASixthEditionOfficeOnline.xsl" StyleName="APA"')
+
+def xml_escape(text) -> str:
+    """Escape text and attribute values the way minidom does"""
+    return str(text).replace("&", "&amp;").replace("<", "&lt;").replace("\"", "&quot;").replace(">", "&gt;")
+
+def xml_element(depth: int, tag: str, text) -> str:
+    """One indented text element, laid out like minidom's toprettyxml"""
+    if text == "":
+        return f"{'  ' * depth}<{tag}/>\n"
+    return f"{'  ' * depth}<{tag}>{xml_escape(text)}</{tag}>\n"
+
+def msword_source_xml(number: int, metadata) -> str:
+    """The b:Source element of one record (or raw CrossRef metadata)"""
+    if isinstance(metadata, dict):
+        metadata = normalize_metadata(metadata)
+    
+    # Tag (unique identifier) and source type (most will be journal articles)
+    parts = ["  <b:Source>\n",
+             xml_element(2, "b:Tag", f"Source{number}"),
+             xml_element(2, "b:SourceType", "ArticleInAPeriodical")]
+    
+    # Title
+    if metadata.title is not None:
+        parts.append(xml_element(2, "b:Title", metadata.title))
+    
+    # Authors
+    if metadata.authors:
+        parts.append("    <b:Author>\n      <b:NameList>\n")
         
-        # Authors
-        if 'author' in metadata and metadata['author']:
-            authors_elem = ET.SubElement(source, "b:Author")
-            name_list = ET.SubElement(authors_elem, "b:NameList")
+        for given, family in metadata.authors[:10]:  # Limit to first 10 authors
+            if given is None and family is None:
+                parts.append("        <b:Person/>\n")
+                continue
             
-            for author in metadata['author'][:10]:  # Limit to first 10 authors
-                person = ET.SubElement(name_list, "b:Person")
-                
-                if 'given' in author:
-                    first = ET.SubElement(person, "b:First")
-                    first.text = author['given']
-                
-                if 'family' in author:
-                    last = ET.SubElement(person, "b:Last")
-                    last.text = author['family']
-        
-        # Journal name
-        if 'container-title' in metadata and metadata['container-title']:
-            journal = ET.SubElement(source, "b:JournalName")
-            journal.text = metadata['container-title'][0]
-        
-        # Year
-        year = ""
-        if 'created' in metadata:
-            year = str(metadata['created']['date-parts'][0][0])
-        elif 'published-print' in metadata:
-            year = str(metadata['published-print']['date-parts'][0][0])
-        elif 'published-online' in metadata:
-            year = str(metadata['published-online']['date-parts'][0][0])
+            parts.append("        <b:Person>\n")
+            if given is not None:
+                parts.append(xml_element(5, "b:First", given))
+            if family is not None:
+                parts.append(xml_element(5, "b:Last", family))
+            parts.append("        </b:Person>\n")
         
-        if year:
-            year_elem = ET.SubElement(source, "b:Year")
-            year_elem.text = year
-        
-        # Volume
-        if 'volume' in metadata:
-            volume = ET.SubElement(source, "b:Volume")
-            volume.text = metadata['volume']
-        
-        # Issue
-        if 'issue' in metadata:
-            issue = ET.SubElement(source, "b:Issue")
-            issue.text = metadata['issue']
-        
-        # Pages
-        if 'page' in metadata:
-            pages = ET.SubElement(source, "b:Pages")
-            pages.text = metadata['page']
-        
-        # DOI
-        if 'DOI' in metadata:
-            doi = ET.SubElement(source, "b:DOI")
-            doi.text = metadata['DOI']
+        parts.append("      </b:NameList>\n    </b:Author>\n")
+    
+    # Journal name
+    if metadata.container is not None:
+        parts.append(xml_element(2, "b:JournalName", metadata.container))
     
-    # Convert to pretty-printed XML string
-    xml_str = ET.tostring(root, encoding='unicode')
-    dom = minidom.parseString(xml_str)
-    return dom.toprettyxml(indent="  ")
+    # Year
+    if metadata.year:
+        parts.append(xml_element(2, "b:Year", metadata.year))
+    
+    # Volume, issue, pages and DOI
+    for tag, value in (("b:Volume", metadata.volume), ("b:Issue", metadata.issue),
+                       ("b:Pages", metadata.page), ("b:DOI", metadata.doi)):
+        if value is not None:
+            parts.append(xml_element(2, tag, value))
+    
+    parts.append("  </b:Source>\n")
+    return ''.join(parts)
 
-def create_tex_file_with_citations(original_text: str, doi_to_key_mapping: Dict[str, str]) -> str:
-    """Replace DOIs in original text with TeX citation commands"""
+def iter_msword_xml(metadata_list):
+    """Yield the MS Word bibliography XML piece by piece: header, one chunk per b:Source, footer"""
+    records = iter(metadata_list)
+    first = next(records, None)
     
-    # Get all DOIs with their positions
-    dois_with_positions = extract_dois_from_text(original_text)
+    if first is None:
+        yield f'<?xml version="1.0" ?>\n{MSWORD_XML_ROOT}/>\n'
+        return
     
-    # Sort by position in reverse order to replace from end to beginning
-    # This prevents position shifts from affecting subsequent replacements
-    dois_with_positions.sort(key=lambda x: x[1], reverse=True)
+    yield f'<?xml version="1.0" ?>\n{MSWORD_XML_ROOT}>\n'
+    for number, metadata in enumerate(itertools.chain([first], records), 1):
+        yield msword_source_xml(number, metadata)
+    yield "</b:Sources>\n"
+
+def write_msword_xml(metadata_list, out):
+    """Write the MS Word bibliography XML to a text stream as it is generated"""
+    for chunk in iter_msword_xml(metadata_list):
+        out.write(chunk)
+
+def metadata_to_msword_xml(metadata_list):
+    """Convert list of records (or raw CrossRef metadata) to MS Word XML bibliography format"""
+    return ''.join(iter_msword_xml(metadata_list))
+
+# Citation syntaxes for rewritten manuscripts: {key} is the BibTeX key and
+# {number} the position of the entry in the generated bibliography
+CITATION_STYLES = {
+    'tex': '\\cite{{{key}}}',
+    'citep': '\\citep{{{key}}}',
+    'citet': '\\citet{{{key}}}',
+    'markdown': '@{key}',
+    'pandoc': '[@{key}]',
+    'numbered': '[{number}]',
+}
+
+def rewrite_citations(original_text: str, doi_to_key_mapping: Dict[str, str], style: str = 'tex',
+                      dois_with_positions: List[Tuple[str, int, int]] = None) -> str:
+    """Replace DOIs in original text with citations in the given style, in a single pass"""
+    template = CITATION_STYLES[style]
+    
+    # Get all DOIs with their positions (reusing the scan of the caller if given)
+    if dois_with_positions is None:
+        dois_with_positions = extract_dois_from_text(original_text)
     
-    result_text = original_text
+    # DOIs are case-insensitive; numbers follow bibliography order
+    keys = {normalize_doi(doi): key for doi, key in doi_to_key_mapping.items()}
+    numbers = {doi: i for i, doi in enumerate(keys, 1)}
     
+    # Join the untouched slices between the spans with the citations
+    parts = []
+    position = 0
     for doi, start_pos, end_pos in dois_with_positions:
-        clean_doi_str = clean_doi(doi)
-        
-        if clean_doi_str in doi_to_key_mapping:
-            bibtex_key = doi_to_key_mapping[clean_doi_str]
-            citation_command = f"\\cite{{{bibtex_key}}}"
-            
-            # Replace the DOI with the citation command
-            result_text = result_text[:start_pos] + citation_command + result_text[end_pos:]
-            
-            app.logger.info(f"Replaced DOI '{doi}' at {start_pos}-{end_pos} with '{citation_command}'")
+        doi = normalize_doi(doi)
+        bibtex_key = keys.get(doi)
+        if bibtex_key is None or start_pos < position:
+            continue
+        parts.append(original_text[position:start_pos])
+        parts.append(template.format(key=bibtex_key, number=numbers[doi]))
+        position = end_pos
+    parts.append(original_text[position:])
     
-    return result_text
+    return ''.join(parts)
 
-def create_markdown_file_with_citations(original_text: str, doi_to_key_mapping: Dict[str, str]) -> str:
+def create_tex_file_with_citations(original_text: str, doi_to_key_mapping: Dict[str, str],
+                                   dois_with_positions: List[Tuple[str, int, int]] = None) -> str:
+    """Replace DOIs in original text with TeX citation commands"""
+    return rewrite_citations(original_text, doi_to_key_mapping, 'tex', dois_with_positions)
+
+def create_markdown_file_with_citations(original_text: str, doi_to_key_mapping: Dict[str, str],
+                                        dois_with_positions: List[Tuple[str, int, int]] = None) -> str:
     """Replace DOIs in original text with Markdown citation commands for Pandoc"""
+    return rewrite_citations(original_text, doi_to_key_mapping, 'markdown', dois_with_positions)
+
+def bibtex_document(entries: List[str], total: int, failed_dois: List[str],
+                    known: int = 0, library: str = None) -> str:
+    """
+    Assemble the BibTeX output from the entries in input order; known counts
+    DOIs skipped because the library has them, and a library is prepended
+    (merge mode)
+    """
+    parts = []
+    if library and library.strip():
+        parts.append(library.rstrip() + "\n\n")
     
-    # Get all DOIs with their positions
-    dois_with_positions = extract_dois_from_text(original_text)
+    parts.append(f"% Generated {len(entries)} BibTeX entries from {total} DOIs\n")
+    if known:
+        parts.append(f"% {known} DOIs were already in the library\n")
+    parts.append("\n")
+    parts.extend(entry + "\n" for entry in entries)
     
-    # Sort by position in reverse order to replace from end to beginning
-    # This prevents position shifts from affecting subsequent replacements
-    dois_with_positions.sort(key=lambda x: x[1], reverse=True)
+    if failed_dois:
+        parts.append(f"\n% Failed to process: {', '.join(failed_dois)}\n")
     
-    result_text = original_text
+    return ''.join(parts)
+
+def citation_outputs(input_text: str, doi_to_key_mapping: Dict[str, str],
+                     dois_with_positions: List[Tuple[str, int, int]],
+                     for_tex: bool, for_markdown: bool, citation_style: str = None) -> Dict[str, str]:
+    """Rewritten copies of the input text requested alongside the BibTeX output"""
+    outputs = {}
     
-    for doi, start_pos, end_pos in dois_with_positions:
-        clean_doi_str = clean_doi(doi)
-        
-        if clean_doi_str in doi_to_key_mapping:
-            bibtex_key = doi_to_key_mapping[clean_doi_str]
-            citation_command = f"@{bibtex_key}"
-            
-            # Replace the DOI with the citation command
-            result_text = result_text[:start_pos] + citation_command + result_text[end_pos:]
-            
-            app.logger.info(f"Replaced DOI '{doi}' at {start_pos}-{end_pos} with '{citation_command}'")
+    if for_tex:
+        outputs['tex_content'] = create_tex_file_with_citations(input_text, doi_to_key_mapping, dois_with_positions)
+    
+    if for_markdown:
+        outputs['markdown_content'] = create_markdown_file_with_citations(input_text, doi_to_key_mapping, dois_with_positions)
     
-    return result_text
+    if citation_style:
+        outputs['citation_content'] = rewrite_citations(input_text, doi_to_key_mapping, citation_style, dois_with_positions)
+    
+    return outputs
 
-@app.route('/')
-def index():
-    """Serve the main page"""
-    return render_template_string(HTML_TEMPLATE)
+OUTPUT_FORMATS = ('bibtex', 'xml')
+LIBRARY_MODES = ('delta', 'merge')
 
-@app.route('/convert', methods=['POST'])
-def convert_dois():
-    """Convert DOIs to requested format"""
-    try:
-        input_text = request.form.get('dois', '').strip()
-        output_format = request.form.get('format', 'bibtex')
-        for_tex = request.form.get('forTex') == 'on'
-        for_markdown = request.form.get('forMarkdown') == 'on'
-        
-        if not input_text:
-            return "Please enter some text or DOIs", 400
-        
-        # Parse input text to extract DOIs
-        dois = parse_input_text(input_text)
-        
-        if not dois:
-            return "No valid DOIs found in the input text", 400
-        
-        # Remove duplicates while preserving order
-        unique_dois = list(dict.fromkeys(dois))
-        
-        app.logger.info(f"Found {len(unique_dois)} unique DOIs: {unique_dois}")
-        
-        # Fetch metadata for all DOIs
-        metadata_list = []
-        failed_dois = []
-        doi_to_key_mapping = {}  # For TeX citation mapping
-        
-        for i, doi in enumerate(unique_dois):
-            app.logger.info(f"Processing DOI {i+1}/{len(unique_dois)}: {doi}")
-            metadata = fetch_doi_metadata(doi)
+class ConversionError(Exception):
+    """Invalid input or nothing to convert; reported to the client as a 400"""
+
+def conversion_options(form, files=None) -> dict:
+    """Validated conversion options from the submitted form fields"""
+    options = {
+        'input_text': form.get('dois', '').strip(),
+        'output_format': form.get('format', 'bibtex'),
+        'for_tex': form.get('forTex') == 'on',
+        'for_markdown': form.get('forMarkdown') == 'on',
+        'citation_style': form.get('citationStyle') or None,  # Optional extra rewritten text
+        # Existing .bib library: only DOIs missing from it are resolved, and new keys don't clash with it
+        'library': form.get('library', ''),
+        'library_mode': form.get('libraryMode') or 'delta',  # Return only new entries, or the merged library
+    }
+    
+    if files and files.get('libraryFile'):
+        options['library'] = files['libraryFile'].read().decode('utf-8', errors='replace')
+    
+    if not options['input_text']:
+        raise ConversionError("Please enter some text or DOIs")
+    
+    if options['output_format'] not in OUTPUT_FORMATS:
+        raise ConversionError("Invalid output format")
+    
+    if options['citation_style'] and options['citation_style'] not in CITATION_STYLES:
+        raise ConversionError(f"Invalid citation style, choose from: {', '.join(CITATION_STYLES)}")
+    
+    if options['library_mode'] not in LIBRARY_MODES:
+        raise ConversionError(f"Invalid library mode, choose from: {', '.join(LIBRARY_MODES)}")
+    
+    return options
+
+def find_dois(input_text: str, log: ConversionLog = None) -> Tuple[List[str], List[Tuple[str, int, int]]]:
+    """Unique DOIs of the input in order, and their spans for the TeX/Markdown rewriting"""
+    log = log or ConversionLog('scan')
+    with log.phase('scan'):
+        # Scan once; the spans are reused for the rewriting
+        dois_with_positions = extract_dois_from_text(input_text)
+        dois = parse_input_text(input_text, dois_with_positions)
+    
+    if not dois:
+        raise ConversionError("No valid DOIs found in the input text")
+    
+    # Remove duplicates (DOIs are case-insensitive) while preserving order
+    unique = {}
+    for doi in dois:
+        unique.setdefault(normalize_doi(doi), doi)
+    unique_dois = list(unique.values())
+    
+    log.set(text_length=len(input_text), dois=len(unique_dois))
+    app.logger.debug("Found %d unique DOIs: %s", len(unique_dois), unique_dois)
+    return unique_dois, dois_with_positions
+
+def split_known_dois(unique_dois: List[str], library: str) -> Tuple[List[str], List[str], Dict[str, str]]:
+    """
+    Index a library by DOI: returns its keys, the DOIs still to resolve, and
+    the library keys of the DOIs it already has
+    """
+    entries = parse_bib_library(library) if library else []
+    library_dois = {doi: key for key, doi, _ in entries if doi}
+    
+    new_dois = []
+    known = {}
+    for doi in unique_dois:
+        key = library_dois.get(normalize_doi(doi))
+        if key:
+            known[doi] = key
+        else:
+            new_dois.append(doi)
+    
+    return [key for key, _, _ in entries], new_dois, known
+
+def convert_text(input_text: str, output_format: str = 'bibtex', for_tex: bool = False, for_markdown: bool = False,
+                 citation_style: str = None, library: str = '', library_mode: str = 'delta', progress=None,
+                 log: ConversionLog = None, executor: ThreadPoolExecutor = None) -> Tuple[str, str]:
+    """
+    Convert the DOIs found in a text, returning the response body and its
+    mimetype. The body is a string, or an iterable of chunks for XML output.
+    """
+    log = log or ConversionLog('convert')
+    log.set(format=output_format)
+    unique_dois, dois_with_positions = find_dois(input_text, log)
+    
+    # The library only matters for BibTeX: DOIs it has are cited with its keys, not resolved again
+    library_keys, new_dois, known = split_known_dois(unique_dois, library if output_format == 'bibtex' else '')
+    
+    # Fetch metadata for the remaining DOIs
+    with log.phase('fetch'):
+        results = dict(zip(new_dois, fetch_all_metadata(new_dois, progress, log, executor)))
+    
+    metadata_list = []
+    bibtex_entries = []
+    failed_dois = []
+    doi_to_key_mapping = {}  # For TeX citation mapping
+    allocator = BibKeyAllocator(library_keys)
+    
+    with log.phase('render'):
+        for doi in unique_dois:
+            if doi in known:
+                doi_to_key_mapping[doi] = known[doi]
+                continue
+            
+            metadata = results[doi]
             if metadata:
                 metadata_list.append(metadata)
                 # Store the mapping from DOI to BibTeX key for TeX generation
                 if output_format == 'bibtex':
-                    _, bibtex_key = metadata_to_bibtex(metadata)
+                    bibtex_key = allocator.allocate(metadata, doi)
+                    bibtex_entry, _ = metadata_to_bibtex(metadata, bibtex_key)
+                    bibtex_entries.append(bibtex_entry)
                     doi_to_key_mapping[doi] = bibtex_key
             else:
                 failed_dois.append(doi)
-        
-        if not metadata_list:
-            return f"Failed to fetch metadata for all DOIs: {', '.join(failed_dois)}", 400
-        
-        # Generate output based on format
-        if output_format == 'bibtex':
-            result = f"% Generated {len(metadata_list)} BibTeX entries from {len(unique_dois)} DOIs\n\n"
-            for metadata in metadata_list:
-                bibtex_entry, _ = metadata_to_bibtex(metadata)
-                result += bibtex_entry + "\n"
-            
-            if failed_dois:
-                result += f"\n% Failed to process: {', '.join(failed_dois)}\n"
+    
+    log.set(resolved=len(metadata_list), failed=len(failed_dois), known=len(known))
+    
+    if failed_dois and not metadata_list:
+        raise ConversionError(f"Failed to fetch metadata for all DOIs: {', '.join(failed_dois)}")
+    
+    # Generate output based on format
+    if output_format == 'bibtex':
+        with log.phase('render'):
+            result = bibtex_document(bibtex_entries, len(new_dois), failed_dois, len(known),
+                                     library if library_mode == 'merge' else None)
             
-            # Generate TeX and/or Markdown files if requested
-            if for_tex or for_markdown:
+            # Generate TeX, Markdown and/or other rewritten files if requested
+            if for_tex or for_markdown or citation_style:
                 response_data = {
                     'main_content': result
                 }
-                
-                if for_tex:
-                    tex_content = create_tex_file_with_citations(input_text, doi_to_key_mapping)
-                    response_data['tex_content'] = tex_content
-                
-                if for_markdown:
-                    markdown_content = create_markdown_file_with_citations(input_text, doi_to_key_mapping)
-                    response_data['markdown_content'] = markdown_content
+                response_data.update(citation_outputs(input_text, doi_to_key_mapping, dois_with_positions,
+                                                      for_tex, for_markdown, citation_style))
                 
                 # Return all files as JSON
-                return Response(json.dumps(response_data), mimetype='application/json')
-            else:
-                return Response(result, mimetype='text/plain')
+                return json.dumps(response_data), 'application/json'
         
-        elif output_format == 'xml':
-            result = metadata_to_msword_xml(metadata_list)
+        return result, 'text/plain'
+    
+    # Streamed to the client as it is written, without building the whole document
+    result = iter_msword_xml(metadata_list)
+    
+    if failed_dois:
+        result = itertools.chain(result, [
+            f"\n<!-- Generated {len(metadata_list)} entries from {len(unique_dois)} DOIs -->\n"
+            f"<!-- Failed to process: {', '.join(failed_dois)} -->\n"])
+    
+    # Note: TeX/Markdown generation doesn't make sense for XML format
+    return result, 'application/xml'
+
+def sse_event(event: str, data) -> str:
+    """Format one Server-Sent Event with a JSON payload"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def stream_bibtex_conversion(input_text, unique_dois, dois_with_positions, for_tex, for_markdown, citation_style,
+                             library='', library_mode='delta', log: ConversionLog = None):
+    """
+    Generate Server-Sent Events for a BibTeX conversion: an 'entry' (or 'failed')
+    event per DOI as soon as it and all DOIs before it are looked up, 'progress'
+    events as lookups finish, and a final 'summary' with the assembled output
+    and the failed DOIs
+    """
+    log = log or ConversionLog('stream')
+    library_keys, new_dois, known = split_known_dois(unique_dois, library)
+    all_dois, unique_dois = unique_dois, new_dois  # Only DOIs missing from the library are looked up
+    total = len(unique_dois)
+    lookups = iter_metadata(unique_dois, log)
+    allocator = BibKeyAllocator(library_keys)
+    records = [None] * total
+    looked_up = [False] * total
+    results = [None] * total
+    next_index = 0
+    
+    try:
+        yield sse_event('progress', {'done': 0, 'total': total})
+        
+        # Only the waits for lookups count as fetch time; rendering and sending overlap them
+        for done, (index, metadata) in enumerate(log.timed('fetch', lookups), 1):
+            records[index] = metadata
+            looked_up[index] = True
             
-            if failed_dois:
-                result += f"\n<!-- Generated {len(metadata_list)} entries from {len(unique_dois)} DOIs -->\n"
-                result += f"<!-- Failed to process: {', '.join(failed_dois)} -->\n"
+            # Entries go out in input order so that keys are allocated as in the buffered output
+            while next_index < total and looked_up[next_index]:
+                doi = unique_dois[next_index]
+                metadata = records[next_index]
+                
+                if metadata:
+                    with log.phase('render'):
+                        bibtex_key = allocator.allocate(metadata, doi)
+                        bibtex_entry, _ = metadata_to_bibtex(metadata, bibtex_key)
+                    results[next_index] = (bibtex_entry, bibtex_key)
+                    if 'first_entry_ms' not in log.fields:
+                        log.set(first_entry_ms=round(1000 * (time.perf_counter() - log.started), 1))
+                    yield sse_event('entry', {'index': next_index, 'doi': doi, 'key': bibtex_key, 'entry': bibtex_entry})
+                else:
+                    yield sse_event('failed', {'index': next_index, 'doi': doi})
+                
+                next_index += 1
             
-            # Note: TeX/Markdown generation doesn't make sense for XML format
-            return Response(result, mimetype='application/xml')
+            yield sse_event('progress', {'done': done, 'total': total})
         
-        else:
-            return "Invalid output format", 400
+        failed_dois = [doi for doi, result in zip(unique_dois, results) if result is None]
+        log.set(resolved=total - len(failed_dois), failed=len(failed_dois), known=len(known))
+        if failed_dois and len(failed_dois) == total:
+            yield sse_event('error', {'message': f"Failed to fetch metadata for all DOIs: {', '.join(failed_dois)}",
+                                      'failed': failed_dois})
+            return
+        
+        with log.phase('render'):
+            new_keys = {doi: result[1] for doi, result in zip(unique_dois, results) if result}
+            doi_to_key_mapping = {doi: known.get(doi) or new_keys[doi]
+                                  for doi in all_dois if doi in known or doi in new_keys}
+            summary = {
+                'total': total,
+                'converted': len(new_keys),
+                'known': len(known),
+                'failed': failed_dois,
+                'main_content': bibtex_document([result[0] for result in results if result], total, failed_dois,
+                                                len(known), library if library_mode == 'merge' else None),
+            }
+            summary.update(citation_outputs(input_text, doi_to_key_mapping, dois_with_positions,
+                                            for_tex, for_markdown, citation_style))
+        yield sse_event('summary', summary)
+    
+    except Exception as e:
+        app.logger.error("Error in streamed conversion: %s", e)
+        log.set(error=str(e))
+        yield sse_event('error', {'message': f"Server error: {str(e)}"})
+    
+    finally:
+        # Client went away or the stream ended - don't spend lookups on pending DOIs
+        lookups.close()
+        log.emit()
+
+# Background conversion jobs (set DOI_JOBS_PATH to an empty string to disable)
+JOBS_PATH = os.environ.get('DOI_JOBS_PATH', os.path.join(tempfile.gettempdir(), 'bib-convert-jobs.sqlite'))
+JOB_WORKERS = int(os.environ.get('DOI_JOB_WORKERS', 2))
+JOB_STALE_AFTER = 300  # Seconds without progress before a running job is considered orphaned
+JOB_RETENTION = 7 * 24 * 3600  # Seconds finished jobs and their results are kept
+
+class JobStore(SQLiteStore):
+    """On-disk queue of conversion jobs, shared by all WSGI processes"""
+    
+    def __init__(self, path):
+        super().__init__(path)
+        with self.connection() as conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, fingerprint TEXT NOT NULL, status TEXT NOT NULL, options TEXT NOT NULL,
+                done INTEGER NOT NULL DEFAULT 0, total INTEGER NOT NULL DEFAULT 0,
+                result TEXT, mimetype TEXT, error TEXT, created REAL NOT NULL, updated REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_fingerprint ON jobs (fingerprint, status)")
+    
+    def submit(self, options):
+        """Queue a job unless an identical one is pending; returns (job_id, created)"""
+        fingerprint = hashlib.sha256(json.dumps(options, sort_keys=True).encode()).hexdigest()
+        now = time.time()
+        conn = self.connection()
+        with conn:
+            # Lock the database so two processes can't queue the same job
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT id FROM jobs WHERE fingerprint = ? AND status IN ('queued', 'running')",
+                               (fingerprint,)).fetchone()
+            if row:
+                return row[0], False
+            
+            job_id = uuid.uuid4().hex
+            conn.execute("""INSERT INTO jobs (id, fingerprint, status, options, created, updated)
+                VALUES (?, ?, 'queued', ?, ?, ?)""", (job_id, fingerprint, json.dumps(options), now, now))
+            conn.execute("DELETE FROM jobs WHERE status IN ('done', 'failed') AND updated < ?",
+                         (now - JOB_RETENTION,))
+        return job_id, True
+    
+    def claim(self, job_id):
+        """Mark a queued job as running and return its options, or None if another worker has it"""
+        conn = self.connection()
+        with conn:
+            claimed = conn.execute("UPDATE jobs SET status = 'running', updated = ? WHERE id = ? AND status = 'queued'",
+                                   (time.time(), job_id)).rowcount
+        if not claimed:
+            return None
+        return json.loads(conn.execute("SELECT options FROM jobs WHERE id = ?", (job_id,)).fetchone()[0])
+    
+    def progress(self, job_id, done, total):
+        """Record progress, which also serves as the heartbeat of the running job"""
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET done = ?, total = ?, updated = ? WHERE id = ?",
+                         (done, total, time.time(), job_id))
+    
+    def finish(self, job_id, result, mimetype):
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET status = 'done', result = ?, mimetype = ?, updated = ? WHERE id = ?",
+                         (result, mimetype, time.time(), job_id))
+    
+    def fail(self, job_id, error):
+        with self.connection() as conn:
+            conn.execute("UPDATE jobs SET status = 'failed', error = ?, updated = ? WHERE id = ?",
+                         (error, time.time(), job_id))
+    
+    def get(self, job_id):
+        """Job record as a dict, or None if unknown"""
+        conn = self.connection()
+        conn.row_factory = sqlite3.Row
+        try:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        finally:
+            conn.row_factory = None
+        return dict(row) if row else None
+    
+    def requeue_stale(self):
+        """Requeue running jobs whose worker stopped reporting; returns all queued job ids"""
+        conn = self.connection()
+        with conn:
+            conn.execute("UPDATE jobs SET status = 'queued' WHERE status = 'running' AND updated < ?",
+                         (time.time() - JOB_STALE_AFTER,))
+        return [row[0] for row in conn.execute("SELECT id FROM jobs WHERE status = 'queued' ORDER BY created")]
+
+job_store = None
+if JOBS_PATH:
+    try:
+        job_store = JobStore(JOBS_PATH)
+    except sqlite3.Error as e:
+        # Fallback if the job store can't be created
+        app.logger.warning("Background jobs disabled: %s", e)
+
+job_executor = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='jobs')
+
+def run_job(job_id):
+    """Job worker: claim a queued job and run its conversion"""
+    options = job_store.claim(job_id)
+    if options is None:
+        return
+    
+    last_report = [0.0]
+    
+    def report(done, total):
+        # At most one write per second, plus the final count
+        now = time.monotonic()
+        if done == total or now - last_report[0] >= 1:
+            last_report[0] = now
+            job_store.progress(job_id, done, total)
+    
+    log = ConversionLog('job')
+    log.set(job=job_id)
+    try:
+        result, mimetype = convert_text(progress=report, log=log, executor=job_fetch_executor, **options)
+        job_store.finish(job_id, result if isinstance(result, str) else ''.join(result), mimetype)
+    except ConversionError as e:
+        log.set(error=str(e))
+        job_store.fail(job_id, str(e))
+    except Exception as e:
+        app.logger.error("Error in job %s: %s", job_id, e)
+        log.set(error=str(e))
+        job_store.fail(job_id, f"Server error: {str(e)}")
+    finally:
+        log.emit()
+
+def resume_jobs():
+    """Queue jobs left over from a previous run of the service or orphaned by a dead worker"""
+    for job_id in job_store.requeue_stale():
+        job_executor.submit(run_job, job_id)
+
+if job_store:
+    resume_jobs()
+
+@app.route('/')
+def index():
+    """Serve the main page"""
+    return render_template_string(HTML_TEMPLATE)
+
+@app.route('/cache/stats')
+def cache_stats():
+    """Report metadata cache hit/miss counters for this process"""
+    if not metadata_cache:
+        return jsonify({'enabled': False})
+    return jsonify(dict(metadata_cache.stats(), enabled=True))
+
+@app.route('/convert', methods=['POST'])
+def convert_dois():
+    """Convert DOIs to requested format"""
+    log = ConversionLog('convert')
+    streaming = False
+    try:
+        options = conversion_options(request.form, request.files)
+        
+        # Streaming mode: Server-Sent Events as lookups complete
+        if request.form.get('stream') == 'sse':
+            if options['output_format'] != 'bibtex':
+                return "Streaming is only available for BibTeX output", 400
+            log.set(mode='stream', format='bibtex')
+            unique_dois, dois_with_positions = find_dois(options['input_text'], log)
+            events = stream_bibtex_conversion(options['input_text'], unique_dois, dois_with_positions,
+                                              options['for_tex'], options['for_markdown'], options['citation_style'],
+                                              options['library'], options['library_mode'], log)
+            # The stream logs the summary when it ends
+            streaming = True
+            return Response(events, mimetype='text/event-stream',
+                            headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        
+        result, mimetype = convert_text(log=log, **options)
+        return Response(result, mimetype=mimetype)
+    
+    except ConversionError as e:
+        log.set(error=str(e))
+        return str(e), 400
     
     except Exception as e:
-        app.logger.error(f"Error in convert_dois: {str(e)}")
+        app.logger.error("Error in convert_dois: %s", e)
+        log.set(error=str(e))
         return f"Server error: {str(e)}", 500
+    
+    finally:
+        if not streaming:
+            log.emit()
+
+def job_status(job):
+    """Public view of a job record"""
+    return {
+        'id': job['id'],
+        'status': job['status'],  # queued, running, done or failed
+        'done': job['done'],
+        'total': job['total'],
+        'error': job['error'],
+        'created': job['created'],
+        'updated': job['updated'],
+        'status_url': url_for('get_job', job_id=job['id']),
+        'result_url': url_for('get_job_result', job_id=job['id']),
+    }
+
+@app.route('/jobs', methods=['POST'])
+def submit_job():
+    """Queue a conversion (same form fields as /convert) to run in the background"""
+    if not job_store:
+        return "Background jobs are disabled", 503
+    
+    try:
+        options = conversion_options(request.form, request.files)
+        find_dois(options['input_text'])  # Reject input without DOIs right away
+    except ConversionError as e:
+        return str(e), 400
+    
+    job_id, created = job_store.submit(options)
+    if created:
+        job_executor.submit(run_job, job_id)
+    
+    return jsonify(dict(job_status(job_store.get(job_id)), deduplicated=not created)), 202
+
+@app.route('/jobs/<job_id>')
+def get_job(job_id):
+    """Poll the status and progress of a job"""
+    job = job_store.get(job_id) if job_store else None
+    if not job:
+        return "Unknown job", 404
+    
+    if job['status'] == 'running' and time.time() - job['updated'] > JOB_STALE_AFTER:
+        # Its worker died; pick it up again here
+        resume_jobs()
+        job = job_store.get(job_id)
+    
+    return jsonify(job_status(job))
+
+@app.route('/jobs/<job_id>/result')
+def get_job_result(job_id):
+    """Fetch the output of a finished job"""
+    job = job_store.get(job_id) if job_store else None
+    if not job:
+        return "Unknown job", 404
+    
+    if job['status'] == 'failed':
+        return job['error'], 400
+    
+    if job['status'] != 'done':
+        return jsonify(job_status(job)), 409
+    
+    return Response(job['result'], mimetype=job['mimetype'])
 
 # Production configuration
 if __name__ == "__main__":
     # This section won't be used in WSGI deployment
-    app.run(host='0.0.0.0', port=5000, debug=False)
+    parser = argparse.ArgumentParser(description="DOI Bibliography Converter")
+    commands = parser.add_subparsers(dest='command')
+    ingest_parser = commands.add_parser('ingest', help="load CrossRef JSON-lines dumps into the local metadata store")
+    ingest_parser.add_argument('dumps', nargs='+', metavar='PATH', help="JSON-lines dump, optionally .gz")
+    ingest_parser.add_argument('--db', default=LOCAL_METADATA_PATH or None, required=not LOCAL_METADATA_PATH,
+                               help="store to write (default: $DOI_LOCAL_METADATA_PATH)")
+    args = parser.parse_args()
+    
+    if args.command == 'ingest':
+        store = LocalMetadataStore(args.db)
+        for dump in args.dumps:
+            started = time.perf_counter()
+            stored = store.ingest(dump)
+            print(f"{dump}: {stored} works in {time.perf_counter() - started:.1f}s")
+        print(f"{args.db}: {store.stats()['entries']} works")
+    else:
+        app.run(host='0.0.0.0', port=5000, debug=False)
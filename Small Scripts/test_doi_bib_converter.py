@@ -0,0 +1,199 @@
+"""
+Offline tests of the CrossRef batch resolver against a local http.server stub.
+Run with pytest; no network access is needed.
+"""
+import gzip
+import importlib
+import json
+import os
+import sys
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+import pytest
+
+class CrossRefStub(BaseHTTPRequestHandler):
+    """
+    /works/<doi> and /works?filter=doi:... DOIs containing 'missing' are unknown;
+    those containing 'nobulk' are only found by single lookups
+    """
+    requests = []
+    fail_filter = False
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/works':
+            self.requests.append('filter')
+            dois = [f[4:] for f in parse_qs(url.query)['filter'][0].split(',')]
+            body = {'message': {'items': [work(doi) for doi in dois if 'nobulk' not in doi and 'missing' not in doi]}}
+            status = 500 if self.fail_filter else 200
+        else:
+            self.requests.append('single')
+            doi = unquote(url.path[len('/works/'):])
+            body = {'message': work(doi)}
+            status = 404 if 'missing' in doi else 200
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def work(doi):
+    return {'DOI': doi, 'type': 'journal-article', 'title': [f'Title of {doi}'],
+            'author': [{'given': 'Ada', 'family': 'Lovelace'}], 'created': {'date-parts': [[2020, 1, 1]]}}
+
+@pytest.fixture(scope='session')
+def crossref_url():
+    """Serve the stub on a free port for the whole session"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), CrossRefStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}'
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(scope='session')
+def converter(crossref_url):
+    """The app module, imported against the stub with the on-disk stores disabled"""
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        for name, value in {'CROSSREF_API_URL': crossref_url, 'DOI_CACHE_PATH': '', 'DOI_JOBS_PATH': '',
+                            'DOI_LOCAL_METADATA_PATH': '', 'DOI_OFFLINE': '', 'DOI_LOG_FILE': os.devnull}.items():
+            monkeypatch.setenv(name, value)
+        monkeypatch.syspath_prepend(os.path.dirname(os.path.abspath(__file__)))
+        yield importlib.import_module('doi_bib_converter')
+    sys.modules.pop('doi_bib_converter', None)
+
+@pytest.fixture
+def stub():
+    CrossRefStub.requests = []
+    CrossRefStub.fail_filter = False
+    return CrossRefStub
+
+def test_batch_hit_needs_one_query(converter, stub):
+    dois = ['10.1000/a', '10.1000/B', '10.1000/c']
+    records = converter.fetch_all_metadata(dois)
+    assert [record.doi for record in records] == dois
+    assert stub.requests == ['filter']
+
+def test_batch_miss_falls_back_to_single_lookup(converter, stub):
+    records = converter.fetch_all_metadata(['10.1000/d', '10.1000/nobulk', '10.1000/missing'])
+    assert [record and record.doi for record in records] == ['10.1000/d', '10.1000/nobulk', None]
+    assert sorted(stub.requests) == ['filter', 'single', 'single']
+
+def test_failed_batch_falls_back_to_single_lookups(converter, stub):
+    stub.fail_filter = True
+    records = converter.fetch_all_metadata(['10.1000/e', '10.1000/f'])
+    assert [record.doi for record in records] == ['10.1000/e', '10.1000/f']
+    assert sorted(stub.requests) == ['filter', 'single', 'single']
+
+def test_empty_title_and_journal_are_kept(converter):
+    metadata = converter.normalize_metadata(dict(work('10.1000/empty'), title=[''], **{'container-title': ['']}))
+    bibtex, _ = converter.metadata_to_bibtex(metadata)
+    assert 'title = {}' in bibtex and 'journal = {}' in bibtex
+    assert '<b:Title/>' in converter.metadata_to_msword_xml([metadata])
+
+def smith(converter, doi):
+    return converter.normalize_metadata(dict(work(doi), author=[{'given': 'Jane', 'family': 'Smith'}]))
+
+def test_key_suffixes_run_past_z(converter):
+    assert [converter.key_suffix(n) for n in (0, 1, 25, 26, 27, 51, 52, 701, 702)] == [
+        'a', 'b', 'z', 'aa', 'ab', 'az', 'ba', 'zz', 'aaa']
+
+def test_keys_are_disambiguated_within_a_batch(converter):
+    allocator = converter.BibKeyAllocator()
+    keys = [allocator.allocate(smith(converter, f'10.1000/s{i}')) for i in range(28)]
+    assert keys[:3] == ['Smith2020', 'Smith2020a', 'Smith2020b']
+    assert keys[26:] == ['Smith2020z', 'Smith2020aa']
+
+def test_keys_avoid_library_keys_in_any_case(converter):
+    allocator = converter.BibKeyAllocator(['smith2020', 'SMITH2020A'])
+    assert allocator.allocate(smith(converter, '10.1000/lib')) == 'Smith2020b'
+
+def test_same_doi_gets_the_same_key(converter):
+    allocator = converter.BibKeyAllocator()
+    first = allocator.allocate(smith(converter, '10.1000/Same'))
+    allocator.allocate(smith(converter, '10.1000/other'))
+    assert allocator.allocate(smith(converter, 'https://doi.org/10.1000/same')) == first == 'Smith2020'
+
+LIBRARY = """@string{jn = "Journal of {Nested} Things"}
+@comment{ignored, doi = {10.1000/comment}}
+@article{Old2019,
+  title = {A {Nested {Brace}} title},
+  doi = {https://doi.org/10.1000/KNOWN}
+}
+@book(Paren2018, title = {Parens (and braces)}, doi = "10.1000/paren")
+@misc{NoDoi2017, title = {No DOI}}
+"""
+
+def test_library_entries_are_parsed(converter):
+    entries = converter.parse_bib_library(LIBRARY)
+    assert [(key, doi) for key, doi, _ in entries] == [
+        ('Old2019', '10.1000/known'), ('Paren2018', '10.1000/paren'), ('NoDoi2017', '')]
+    assert entries[0][2].endswith('doi = {https://doi.org/10.1000/KNOWN}\n}')
+    assert entries[1][2] == '@book(Paren2018, title = {Parens (and braces)}, doi = "10.1000/paren")'
+
+def test_library_dois_are_not_resolved_again(converter, stub):
+    keys, new_dois, known = converter.split_known_dois(['10.1000/Known', '10.1000/comment', '10.1000/new'], LIBRARY)
+    assert keys == ['Old2019', 'Paren2018', 'NoDoi2017']
+    assert new_dois == ['10.1000/comment', '10.1000/new']
+    assert known == {'10.1000/Known': 'Old2019'}
+
+    text = "See 10.1000/known and 10.1000/paren and 10.1000/new."
+    delta, _ = converter.convert_text(text, library=LIBRARY, library_mode='delta')
+    merged, _ = converter.convert_text(text, library=LIBRARY, library_mode='merge')
+    assert stub.requests == ['single', 'single']  # Only 10.1000/new, once per conversion
+    assert '@article{Lovelace2020,' in delta and 'Old2019' not in delta
+    assert '% 2 DOIs were already in the library' in delta
+    assert merged.startswith(LIBRARY.rstrip()) and merged.endswith(delta)
+
+@pytest.fixture
+def local_store(converter, tmp_path, monkeypatch):
+    """A local metadata store ingested from a small gzipped dump, in use for the test"""
+    lines = [json.dumps(work('10.1000/bare')), json.dumps({'message': work('10.1000/MESSAGE')}),
+             json.dumps({'items': [work('10.1000/item1'), work('10.1000/item2')]}),
+             '{"DOI": "10.1000/truncated", ', '', json.dumps([1, 2]), json.dumps({'title': ['No DOI']})]
+    dump = tmp_path / 'works.jsonl.gz'
+    with gzip.open(dump, 'wt', encoding='utf-8') as f:
+        f.write('\n'.join(lines) + '\n')
+
+    store = converter.LocalMetadataStore(str(tmp_path / 'works.db'))
+    assert store.ingest(str(dump)) == 4
+    monkeypatch.setattr(converter, 'local_metadata', store)
+    return store
+
+def test_ingest_skips_malformed_lines(local_store):
+    assert local_store.stats() == {'entries': 4}
+    assert local_store.get('10.1000/message').title == 'Title of 10.1000/MESSAGE'
+    assert local_store.get('10.1000/truncated') is None
+
+def test_local_hits_skip_crossref(converter, local_store, stub):
+    records = converter.fetch_all_metadata(['10.1000/bare', 'https://doi.org/10.1000/Message', '10.1000/item2'])
+    assert [record.doi for record in records] == ['10.1000/bare', '10.1000/MESSAGE', '10.1000/item2']
+    assert stub.requests == []
+
+def test_offline_misses_fail(converter, local_store, stub, monkeypatch):
+    monkeypatch.setattr(converter, 'OFFLINE', True)
+    records = converter.fetch_all_metadata(['10.1000/item1', '10.1000/elsewhere', '10.1000/elsewhere2'])
+    assert [record and record.doi for record in records] == ['10.1000/item1', None, None]
+    assert converter.fetch_doi_metadata('10.1000/elsewhere') is None
+
+    bibtex, _ = converter.convert_text("10.1000/bare and 10.1000/elsewhere")
+    assert bibtex.endswith("% Failed to process: 10.1000/elsewhere\n")
+    assert stub.requests == []
+
+def test_each_doi_form_is_scanned_once(converter):
+    text = "See https://doi.org/10.1000/url1. Also doi:10.1000/Prefixed and (10.1000/bare), or http://dx.doi.org/10.1000/dx."
+    spans = converter.extract_dois_from_text(text)
+
+    assert [doi for doi, _, _ in spans] == ['10.1000/url1', '10.1000/Prefixed', '10.1000/bare', '10.1000/dx']
+    assert [text[start:end] for _, start, end in spans] == [
+        'https://doi.org/10.1000/url1', 'doi:10.1000/Prefixed', '10.1000/bare', 'http://dx.doi.org/10.1000/dx']
+    assert all(end <= next_start for (_, _, end), (_, next_start, _) in zip(spans, spans[1:]))
+
+    mapping = {'10.1000/URL1': 'Url2020', '10.1000/prefixed': 'Pre2020', '10.1000/bare': 'Bare2020',
+               '10.1000/dx': 'Dx2020'}
+    assert converter.rewrite_citations(text, mapping, dois_with_positions=spans) == (
+        "See \\cite{Url2020}. Also \\cite{Pre2020} and (\\cite{Bare2020}), or \\cite{Dx2020}.")
@@ -0,0 +1,232 @@
+"""
+Benchmark harness for the solar irradiance pipelines in this folder.
+
+Runs the Python backends of lumi.py (skyfield, noaa) and any built C++/CSPICE
+binaries (lumi3, lumi4, lumi4c) on the same days and grid resolutions, and
+writes a JSON report with cells/second, peak RSS, output-write time and the
+largest irradiance difference against the reference (first) backend.
+
+wall_cells_per_second counts the whole run (process start, ephemeris or kernel
+load, compute and write) and is the figure to compare across backends and
+against a baseline. cells_per_second is compute-only where that is measured
+(the Python backends) and falls back to wall time for the C++ binaries.
+
+Every run is a separate process so that peak RSS is measured per run. Run it
+from a directory holding de421.bsp (and the SPICE kernels for the C++ binaries):
+
+    python bench_lumi.py --dates 2019-01-01 2019-06-21 --resolutions 1 0.5 \\
+        --cpp ./lumi4c --report bench.json
+
+lumi4/lumi4c take <start> <interval_minutes> <steps> <resolution> and are driven
+with the same day and grid. lumi3 takes no arguments (2019-01-01, one step,
+1/12°) and is only comparable on that day.
+"""
+import numpy as np
+import xarray as xr
+from datetime import datetime, timedelta
+from skyfield.api import utc
+import subprocess
+import argparse
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+
+import lumi
+
+# A forked child inherits the parent's RSS high-water mark, so runs are started
+# from this minimal launcher instead of from the (large) benchmark process
+rusage_launcher = """
+import os, sys
+pid = os.spawnv(os.P_NOWAIT, sys.argv[1], sys.argv[1:])
+_, status, usage = os.wait4(pid, 0)
+print(f"PEAK_RSS_KB {usage.ru_maxrss}", flush=True)
+sys.exit(os.waitstatus_to_exitcode(status))
+"""
+
+def measure_python(backend, date, step, resolution, output):
+    """Child process: time compute and write of one day with lumi.py and print the timings as JSON."""
+    lumi.configure_grid(resolution)
+    if backend == 'skyfield':
+        lumi.load_ephemeris()  # one-off cost, not part of the per-day throughput
+
+    started = time.perf_counter()
+    times, solar_irradiance, luminance = lumi.compute_day(date, timedelta(minutes=step), (24 * 60) // step, backend)
+    computed = time.perf_counter()
+    lumi.write_netcdf(output, times, solar_irradiance, luminance, backend=backend)
+    written = time.perf_counter()
+
+    print(json.dumps({'compute_seconds': computed - started, 'write_seconds': written - computed}))
+
+def run_measured(command, cwd=None):
+    """Run a command and return its output, wall time (s) and peak RSS (MB, including its children)."""
+    started = time.perf_counter()
+    process = subprocess.run([sys.executable, "-c", rusage_launcher, *command], cwd=cwd,
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    elapsed = time.perf_counter() - started
+
+    if process.returncode != 0:
+        raise RuntimeError(f"{' '.join(command)} failed with code {process.returncode}:\n{process.stdout}")
+    output, peak_rss = process.stdout.rsplit("PEAK_RSS_KB ", 1)
+    return output, elapsed, int(peak_rss) / 1024  # ru_maxrss is in KB on Linux
+
+def run_python(backend, date, step, resolution, directory):
+    output = os.path.join(directory, f"python_{backend}_{date.strftime('%Y%m%d')}_res{resolution}.nc")
+    stdout, elapsed, peak_rss = run_measured([
+        sys.executable, os.path.abspath(__file__), "--measure-python", backend,
+        date.strftime('%Y-%m-%d'), str(step), str(resolution), output])
+    timings = json.loads(stdout.strip().splitlines()[-1])
+    return output, elapsed, peak_rss, timings['compute_seconds'], timings['write_seconds']
+
+def run_cpp(binary, date, step, resolution, directory):
+    """
+    Run a CSPICE binary in the current directory (where its kernels are) and move
+    its output into the benchmark directory. Compute and write are not timed
+    separately, so only the total wall time is reported.
+    """
+    stdout, elapsed, peak_rss = run_measured([
+        os.path.abspath(binary), date.strftime('%Y-%m-%dT%H:%M:%S.000'), str(step),
+        str((24 * 60) // step), str(resolution)])
+    created = re.search(r"^Created (\S+)", stdout, re.MULTILINE)
+    if not created:
+        raise RuntimeError(f"{binary} did not report an output file:\n{stdout}")
+
+    output = os.path.join(directory, f"{os.path.basename(binary)}_{date.strftime('%Y%m%d')}_res{resolution}.nc")
+    shutil.move(created.group(1), output)
+    return output, elapsed, peak_rss, None, None
+
+def grid_size(path):
+    with xr.open_dataset(path, decode_times=False) as ds:
+        return ds.sizes['time'], ds.sizes['latitude'], ds.sizes['longitude']
+
+def max_difference(reference, other):
+    """
+    Largest absolute irradiance difference (W/m²) on the cells and timesteps two
+    outputs have in common, or None if they share no cells. Coordinates are
+    matched after rounding since the grids are built differently.
+    """
+    def irradiance(path):
+        with xr.open_dataset(path, decode_times=False) as ds:
+            data = ds.solar_irradiance.load()
+        return data.drop_vars('time', errors='ignore').assign_coords(
+            latitude=np.round(data.latitude.values.astype(float), 6),
+            longitude=np.round(data.longitude.values.astype(float), 6))
+
+    a, b = irradiance(reference), irradiance(other)
+    steps = min(a.sizes['time'], b.sizes['time'])
+    a, b = xr.align(a.isel(time=slice(0, steps)), b.isel(time=slice(0, steps)), join='inner')
+    if a.size == 0:
+        return None
+    return float(np.abs(a.values - b.values).max())
+
+def run_benchmarks(dates, resolutions, step, backends, binaries, directory):
+    results = []
+    for date in dates:
+        for resolution in resolutions:
+            reference = None
+            runs = [(f"python-{backend}", run_python, backend) for backend in backends]
+            runs += [(os.path.basename(binary), run_cpp, binary) for binary in binaries]
+
+            for name, runner, target in runs:
+                print(f"{name} {date.strftime('%Y-%m-%d')} at {resolution}°...", flush=True)
+                output, elapsed, peak_rss, compute_seconds, write_seconds = runner(
+                    target, date, step, resolution, directory)
+
+                n_times, n_lat, n_lon = grid_size(output)
+                cells = n_times * n_lat * n_lon
+                result = {
+                    'backend': name,
+                    'date': date.strftime('%Y-%m-%d'),
+                    'resolution': resolution,
+                    'step_minutes': step,
+                    'timesteps': n_times,
+                    'cells': cells,
+                    'wall_seconds': elapsed,
+                    'compute_seconds': compute_seconds,
+                    'write_seconds': write_seconds,
+                    'cells_per_second': cells / (compute_seconds or elapsed),
+                    'wall_cells_per_second': cells / elapsed,
+                    'peak_rss_mb': peak_rss,
+                    'output_bytes': os.path.getsize(output),
+                    'reference': reference and reference['backend'],
+                    'max_abs_difference': reference and max_difference(reference['output'], output),
+                }
+                print(f"  {result['wall_cells_per_second']:,.0f} cells/s (wall), {peak_rss:.0f} MB peak RSS, "
+                      f"max difference {result['max_abs_difference']}")
+                results.append(result)
+                reference = reference or dict(result, output=output)
+    return results
+
+def find_regressions(results, baseline, tolerance):
+    """
+    Runs whose wall-time cells/second fell by more than tolerance (a fraction)
+    against a previous report. Baseline runs without a wall-time figure are ignored.
+    """
+    previous = {(r['backend'], r['date'], r['resolution'], r['step_minutes']): r.get('wall_cells_per_second')
+                for r in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['backend'], result['date'], result['resolution'], result['step_minutes']))
+        if before and result['wall_cells_per_second'] < before * (1 - tolerance):
+            regressions.append(dict(result, baseline_wall_cells_per_second=before))
+    return regressions
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == "--measure-python":
+        backend, day, step, resolution, output = sys.argv[2:7]
+        measure_python(backend, lumi.parse_date(day), int(step), float(resolution), output)
+        raise SystemExit
+
+    parser = argparse.ArgumentParser(description="Benchmark the lumi.py backends and the C++/CSPICE binaries.")
+    parser.add_argument("--dates", nargs="+", type=lumi.parse_date, default=[lumi.parse_date("2019-01-01")],
+                        metavar="YYYY-MM-DD", help="days to compute (default: 2019-01-01)")
+    parser.add_argument("--resolutions", nargs="+", type=float, default=[1.0], metavar="DEGREES",
+                        help="grid resolutions to compute (default: 1)")
+    parser.add_argument("--step", type=int, default=180, metavar="MINUTES",
+                        help="time step within the day (default: 180)")
+    parser.add_argument("--backends", nargs="*", choices=lumi.solar_backends, default=list(lumi.solar_backends),
+                        help="lumi.py backends to run; the first run is the reference (default: all)")
+    parser.add_argument("--cpp", action="append", default=[], metavar="BINARY",
+                        help="built lumi3/lumi4/lumi4c binary to include (repeatable)")
+    parser.add_argument("--keep-outputs", metavar="DIR",
+                        help="keep the NetCDF outputs in this directory instead of a temporary one")
+    parser.add_argument("--report", default="bench_report.json", metavar="PATH",
+                        help="machine-readable JSON report (default: %(default)s)")
+    parser.add_argument("--baseline", metavar="PATH",
+                        help="earlier report to compare against; exits with status 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="allowed drop in wall-time cells/second against the baseline (default: 0.2)")
+    args = parser.parse_args()
+
+    if (24 * 60) % args.step:
+        parser.error("--step must divide 24 hours evenly")
+
+    with tempfile.TemporaryDirectory() as scratch:
+        directory = args.keep_outputs or scratch
+        os.makedirs(directory, exist_ok=True)
+        results = run_benchmarks(args.dates, args.resolutions, args.step, args.backends, args.cpp, directory)
+
+    report = {
+        'created': datetime.now(utc).strftime("%Y-%m-%d %H:%M:%S UTC"),
+        'host': os.uname().nodename,
+        'cpu_count': os.cpu_count(),
+        'results': results,
+    }
+    if args.baseline:
+        with open(args.baseline) as f:
+            report['regressions'] = find_regressions(results, json.load(f), args.tolerance)
+
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Report written to {args.report}")
+
+    for regression in report.get('regressions', []):
+        print(f"REGRESSION {regression['backend']} {regression['date']} at {regression['resolution']}°: "
+              f"{regression['wall_cells_per_second']:,.0f} cells/s vs "
+              f"{regression['baseline_wall_cells_per_second']:,.0f} (wall)")
+    if report.get('regressions'):
+        raise SystemExit(1)
@@ -0,0 +1,102 @@
+"""
+Tests for lumi.py. Run with pytest from a directory holding de421.bsp; the
+tests that need the ephemeris are skipped without it.
+"""
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+import pytest
+import xarray as xr
+from skyfield.api import utc
+from skyfield.errors import EphemerisRangeError
+
+import lumi
+
+needs_ephemeris = pytest.mark.skipif(not os.path.exists('de421.bsp'),
+                                     reason="run from a directory holding de421.bsp")
+
+@pytest.fixture
+def coarse_grid():
+    """A 15° global grid for the duration of a test, then the previous grid back."""
+    saved = lumi.latitudes, lumi.longitudes
+    lumi.configure_grid(15)
+    yield
+    lumi.latitudes, lumi.longitudes = saved
+
+@needs_ephemeris
+@pytest.mark.parametrize('hour', [0, 9, 15])
+def test_grid_matches_per_cell_loop(coarse_grid, hour):
+    lumi.load_ephemeris()
+    time = lumi.ts.utc(2015, 3, 1, hour)
+
+    irradiance, luminance = lumi.calculate_solar_data(time)
+    reference, reference_luminance = lumi.calculate_solar_data_per_cell(time)
+
+    assert np.abs(irradiance - reference).max() <= 0.01
+    assert np.abs(luminance - reference_luminance).max() <= 0.01 * lumi.conversion_factor
+
+@needs_ephemeris
+@pytest.mark.parametrize('year', [1900, 1925, 1950, 1975, 2000, 2015, 2025, 2049])
+def test_noaa_backend_matches_skyfield(coarse_grid, year):
+    """Sample a day of each year against DE421 (which covers 1900-2050)."""
+    times = [datetime(year, 3, 1, tzinfo=utc) + timedelta(minutes=90 * i) for i in range(16)]
+    try:
+        skyfield_suns = lumi.sun_itrs_position(times)
+    except EphemerisRangeError:
+        pytest.skip(f"de421.bsp does not cover {year}")
+    noaa_suns = lumi.sun_itrs_position(times, 'noaa')
+
+    observer_position, zenith = lumi.observer_grid(lumi.latitudes, lumi.longitudes)
+    for skyfield_sun, noaa_sun in zip(skyfield_suns.T, noaa_suns.T):
+        skyfield_sin = lumi.sin_solar_altitude(skyfield_sun, observer_position, zenith)
+        noaa_sin = lumi.sin_solar_altitude(noaa_sun, observer_position, zenith)
+        assert np.degrees(np.abs(np.arcsin(skyfield_sin) - np.arcsin(noaa_sin))).max() <= 0.01
+        assert lumi.solar_constant * np.abs(np.clip(skyfield_sin, 0, None)
+                                            - np.clip(noaa_sin, 0, None)).max() <= 0.3
+
+def test_store_keeps_sub_hour_times_exact(coarse_grid, tmp_path):
+    path = str(tmp_path / 'store.nc')
+    times, irradiance, luminance = lumi.compute_day(datetime(2015, 3, 1, tzinfo=utc), timedelta(minutes=10),
+                                                    144, 'noaa')
+    with lumi.open_store(path) as store:
+        lumi.append_to_store(store, times, irradiance, luminance)
+
+    with xr.open_dataset(path, engine='h5netcdf') as ds:
+        assert (pd.DatetimeIndex(ds.time.values) == pd.DatetimeIndex(times).tz_localize(None)).all()
+        assert ds.sel(time='2015-03-01T00:10:00').solar_irradiance.shape == irradiance.shape[1:]
+
+def write_store(path, days, step):
+    with lumi.open_store(path) as store:
+        for day in days:
+            lumi.append_to_store(store, *lumi.compute_day(day, timedelta(minutes=step), 24 * 60 // step, 'noaa'))
+
+def test_store_resumes_after_last_written_day(coarse_grid, tmp_path):
+    path = str(tmp_path / 'store.nc')
+    start = datetime(2015, 3, 1, tzinfo=utc)
+    write_store(path, [start, start + timedelta(days=1)], 60)
+
+    with lumi.open_store(path) as store:
+        assert lumi.store_resume_date(store, path, start, timedelta(minutes=60)) == start + timedelta(days=2)
+        with pytest.raises(ValueError, match="60-minute step"):
+            lumi.store_resume_date(store, path, start, timedelta(minutes=180))
+        with pytest.raises(ValueError, match="starts on 2015-03-01"):
+            lumi.store_resume_date(store, path, start + timedelta(days=1), timedelta(minutes=60))
+
+def test_store_rejects_another_grid(coarse_grid, tmp_path):
+    path = str(tmp_path / 'store.nc')
+    start = datetime(2015, 3, 1, tzinfo=utc)
+    write_store(path, [start], 180)
+
+    lumi.configure_grid(15, (-60, 60, -180, 180))
+    with lumi.open_store(path) as store, pytest.raises(ValueError, match="grid"):
+        lumi.store_resume_date(store, path, start, timedelta(minutes=180))
+
+def test_aggregates_complete_a_partial_month(coarse_grid, tmp_path):
+    start = datetime(2015, 3, 1, tzinfo=utc)
+    lumi.run_aggregate_backfill(start, start + timedelta(days=2), workers=1, backend='noaa', directory=str(tmp_path))
+    lumi.run_aggregate_backfill(start + timedelta(days=3), start + timedelta(days=5), workers=1, backend='noaa',
+                                directory=str(tmp_path))
+
+    assert lumi.aggregate_file_days(start, str(tmp_path)) == {start + timedelta(days=i) for i in (0, 1, 3, 4)}